@@ -31,7 +31,7 @@ min_samples_leaf = 100
 print("Filling jets...")
 jets, jet_tots = heppy.get_jets(hps)
 print("Computing jet charge...")
-predictors = np.stack([heppy.jet_charges(hps, jets, kappa = kappa, BDT = True) for kappa in np.arange(lower_kappa, upper_kappa, step_kappa)], axis=-1)
+predictors = heppy.compute_jet_charges(jets, np.arange(lower_kappa, upper_kappa, step_kappa))
 
 # Get labels for jets
 labels = np.concatenate((np.zeros(n_files * n_ev_perf),np.ones(n_files * n_ev_perf)))
@@ -5,31 +5,58 @@
 
 import heppy
 from heppy import jet_RGB_images
-from data_import_modified import data_import
+from data_import_modified import iter_event_chunks
 import numpy as np
 import math
+import os
 ##hps parameters is saved here
 import config 
 
 hps = config.hps
+image_path = '../images'
+chunk_size = 20000
+
 #Loop through energies
 for energy in [hps["energy"]]: 
     # Loop through quark and gluon events
     for particle_type in [hps["particle1_type"], hps["particle2_type"]]:
         # Loop through seed number
         for seed_number in range(1,1 + hps["n_files"]):
-            # import the jets
-            jets, jet_tots = data_import('event', range(1,1 + hps["n_files"]), seed_number, particle_type, prefix = energy)
+            # all of the kappas of a scan are binned in a single pass
+            if 'kappas' in hps:
+                kappas = hps['kappas']
+            elif hps['nb_channels'] == 2:
+                kappas = [hps["kappa"]]
+            else:
+                kappas = [hps["kappa"], hps["kappa_two"]]
 
-            # form the jet images
-            if hps['nb_channels'] == 2:
-                jet_images = np.asarray([heppy.pixelate(jet, nb_chan = hps['nb_channels'], charge_image = True, K=hps["kappa"]) for jet in jets])
-            if hps['nb_channels'] == 3:
-                jet_images = np.asarray([heppy.pixelate(jet, nb_chan = hps['nb_channels'], charge_image = True, K=hps["kappa"], K_two = hps["kappa_two"]) for jet in jets])
+            # stream the jets chunk by chunk, forming the images of each chunk
+            # in parallel and appending them to an image store on disk, so 
+            # neither the events nor the images are held in memory. The store
+            # is checkpointed after every chunk, and a rerun after a crash 
+            # continues from the last checkpoint
+            store_name = energy + '-' + particle_type + '-jetimage-seed' + str(seed_number) + '-stream'
+            params = {'energy': energy, 'particle_type': particle_type,
+                      'seed': seed_number, 'kappas': kappas}
+            heppy.pixelate_to_store(store_name, 
+                                    iter_event_chunks(seed_number, particle_type, prefix = energy, chunk_size = chunk_size),
+                                    path = image_path, params = params, resume = True,
+                                    n_workers = None, kappas = kappas)
+            jet_images, header = heppy.load_image_store(store_name, path = image_path)
  
             # save the jet images to file
-            if hps['nb_channels'] == 2:    
-                filename = energy + '-' +  particle_type + '-K=' + str(hps["kappa"]) + '-K2=' + str(0) + '-jetimage-seed' + str(seed_number)
-            if hps['nb_channels'] == 3:
-                filename = energy + '-' +  particle_type + '-K=' + str(hps["kappa"]) + '-K2=' + str(hps["kappa_two"]) + '-jetimage-seed' + str(seed_number)
-            heppy.write_images_to_file(filename, jet_images)
+            if 'kappas' in hps:
+                for i, kappa in enumerate(kappas):
+                    filename = energy + '-' +  particle_type + '-K=' + str(kappa) + '-K2=' + str(0) + '-jetimage-seed' + str(seed_number)
+                    heppy.write_images_to_file(filename, jet_images[:,[0,i+1]], path = image_path)
+            else:
+                if hps['nb_channels'] == 2:    
+                    filename = energy + '-' +  particle_type + '-K=' + str(hps["kappa"]) + '-K2=' + str(0) + '-jetimage-seed' + str(seed_number)
+                if hps['nb_channels'] == 3:
+                    filename = energy + '-' +  particle_type + '-K=' + str(hps["kappa"]) + '-K2=' + str(hps["kappa_two"]) + '-jetimage-seed' + str(seed_number)
+                heppy.write_images_to_file(filename, jet_images, path = image_path)
+
+            # the store is no longer needed once the images are saved
+            del jet_images
+            for ext in ['.npy', '.json']:
+                os.remove(os.path.join(image_path, store_name + ext))
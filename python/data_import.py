@@ -5,16 +5,16 @@
 # beginning. Can also read in events assuming a csv style file format with
 # an extra newline per event, particles listed one per line, comments 
 # beginning with a '#', and lines denoting overal jet properties beginning
-# with 'Event #, [jet_rap], [jet_phi], [jet_pt]'.
+# with 'Event #, [jet_rap], [jet_phi], [jet_pt]'. Event files are parsed in
+# a single vectorized pass by heppy.read_event_file and cached in binary form.
 
 
 import numpy as np
-import csv
 import os
 import heppy
 
 def data_import(data_type, seed_range, path = '', 
-                nevents = 10000, img_size = 33, nb_chan = 1):
+                nevents = 10000, img_size = 33, nb_chan = 1, cache = True, store = True, dtype = np.float32):
 
     """ Imports data produced by the Events.cc script into python. Note that both
     gluon and quark files must be present for the desired seed range. The gluons 
@@ -22,8 +22,9 @@ def data_import(data_type, seed_range, path = '',
     per file.
 
     data_type: Either 'jetimage' or 'event'. These
-               respectively return a numpy array of jet images and a list of events with their particle constituents and a separate
-               list of the overall jet four-vectors.
+               respectively return a numpy array of jet images and a heppy.JetCollection of events with their particle constituents and a separate
+               array of the overall jet four-vectors. Event files may be plain 
+               .txt files or compressed .txt.gz/.txt.bz2 files.
     seed_range: a list or other iterable object containing the seeds for each file
     path: path to directory with the files. Defaults to '../events' and 
           '../images' for the type possible data_types.
@@ -31,6 +32,13 @@ def data_import(data_type, seed_range, path = '',
              the files.
     img_size: the image size of the jet images.
     channels: the channels of the jet image to return.
+    cache: if True, event files are loaded through the binary cache of
+           heppy.load_event_file, i.e. parsed once and memory-mapped afterwards.
+    store: if True, jet images are returned as a read-only memory map of an
+           uncompressed image store in path, which is built from the .npz
+           files on first use (see heppy.load_images).
+    dtype: the dtype of the returned jet images, files stored as float16 are
+           converted on load.
     """
 
     assert data_type in ['jetimage', 'event'], 'data_type not recognized'
@@ -42,27 +50,14 @@ def data_import(data_type, seed_range, path = '',
         return heppy.load_images(['gluon-jetimage-seed{}.npz'.format(x) for x in seed_range],
                                  ['quark-jetimage-seed{}.npz'.format(x) for x in seed_range],
                                  nevents * len(seed_range), nevents * len(seed_range), 
-                                 nb_chan = nb_chan)
+                                 nb_chan = nb_chan, path = path, dtype = dtype,
+                                 store_name = 'jetimage-seeds' + '-'.join(str(x) for x in seed_range) if store else '')
     elif data_type == 'event':
         jets = []
-        jet_tots = []
-
         for particle_type in ['gluon', 'quark']:
             for index in seed_range:
                 filename = particle_type + '-event-seed' + str(index)
-                with open(os.path.join(path, filename + '.txt'), 'r') as fh:
-                    reader = csv.reader(fh)
-                    jet = []
-                    for row in reader:
-                        if len(row) > 0 and '#' in row[0]:
-                            continue
-                        if len(row) > 0 and 'Event' in row[0]:
-                            jet_tots.append(list(map(float, row[1:])))
-                        elif len(row) == 0:
-                            jets.append(np.asarray(jet))
-                            jet = []
-                        else:
-                            jet.append(list(map(float, row)))
+                jets.append(heppy.load_event_file(heppy.find_event_file(os.path.join(path, filename)), cache = cache))
 
-    
-        return jets, jet_tots
+        jets = heppy.concatenate_jets(jets)
+        return jets, jets.jet_tots
@@ -5,17 +5,18 @@
 # beginning. Can also read in events assuming a csv style file format with
 # an extra newline per event, particles listed one per line, comments 
 # beginning with a '#', and lines denoting overal jet properties beginning
-# with 'Event #, [jet_rap], [jet_phi], [jet_pt]'.
+# with 'Event #, [jet_rap], [jet_phi], [jet_pt]'. Event files are parsed in
+# a single vectorized pass by heppy.read_event_file and cached in binary form.
 
 
 import numpy as np
-import csv
 import os
 import heppy
 
 def data_import(data_type, seed_range, seed_number = 1, particle_type = '', 
                 prefix = '', path = '', nevents = 10000, img_size = 33, nb_chan = 1, 
-                particle1_type = 'gluon', particle2_type = 'quark', K = 0, K_two = 0):
+                particle1_type = 'gluon', particle2_type = 'quark', K = 0, K_two = 0,
+                cache = True, store = True, dtype = np.float32):
 
     """ Imports data produced by the Events.cc script into python. Note that both
     gluon and quark files must be present for the desired seed range. The gluons 
@@ -23,8 +24,9 @@ def data_import(data_type, seed_range, seed_number = 1, particle_type = '',
     per file.
 
     data_type: Either 'jetimage' or 'event'. These
-               respectively return a numpy array of jet images and a list of events with their particle constituents and a separate
-               list of the overall jet four-vectors.
+               respectively return a numpy array of jet images and a heppy.JetCollection of events with their particle constituents and a separate
+               array of the overall jet four-vectors. Event files may be plain 
+               .txt files or compressed .txt.gz/.txt.bz2 files.
     seed_range: a list or other iterable object containing the seeds for each file
     path: path to directory with the files. Defaults to '../events' and 
           '../images' for the type possible data_types.
@@ -32,6 +34,13 @@ def data_import(data_type, seed_range, seed_number = 1, particle_type = '',
              the files.
     img_size: the image size of the jet images.
     channels: the channels of the jet image to return.
+    cache: if True, event files are loaded through the binary cache of
+           heppy.load_event_file, i.e. parsed once and memory-mapped afterwards.
+    store: if True, jet images are returned as a read-only memory map of an
+           uncompressed image store in path, which is built from the .npz
+           files on first use (see heppy.load_images).
+    dtype: the dtype of the returned jet images, files stored as float16 are
+           converted on load.
     """
 
     assert data_type in ['jetimage', 'event'], 'data_type not recognized'
@@ -42,29 +51,52 @@ def data_import(data_type, seed_range, seed_number = 1, particle_type = '',
     if data_type == 'jetimage':
         particle1_string = prefix + '-' + particle1_type + '-K=' + str(K) + '-K2=' + str(K_two) + '-jetimage-seed{}_33x33images_' + str(nb_chan) + 'chan.npz'
         particle2_string = prefix + '-' + particle2_type + '-K=' + str(K) + '-K2=' + str(K_two) + '-jetimage-seed{}_33x33images_' + str(nb_chan) + 'chan.npz'
+        store_name = prefix + '-' + particle1_type + '-' + particle2_type + '-K=' + str(K) + '-K2=' + str(K_two) + '-jetimage-seeds' + '-'.join(str(x) for x in seed_range) + '_33x33images_' + str(nb_chan) + 'chan' if store else ''
         return heppy.load_images([particle1_string.format(x) for x in seed_range],
                                  [particle2_string.format(x) for x in seed_range],
                                  nevents * len(seed_range), nevents * len(seed_range), 
-                                 nb_chan = nb_chan)
+                                 nb_chan = nb_chan, path = path, store_name = store_name, dtype = dtype,
+                                 params = {'prefix': prefix, 'K': K, 'K_two': K_two,
+                                           'particle1_type': particle1_type,
+                                           'particle2_type': particle2_type})
 
     elif data_type == 'event':
-        jets = []
-        jet_tots = []
-
-        filename = prefix + '-' + particle_type + '-event-seed' + str(seed_number)
-        with open(os.path.join(path, filename + '.txt'), 'r') as fh:
-            reader = csv.reader(fh)
-            jet = []
-            for row in reader:
-                if len(row) > 0 and '#' in row[0]:
-                    continue
-                if len(row) > 0 and 'Event' in row[0]:
-                     jet_tots.append(list(map(float, row[1:])))
-                elif len(row) == 0:
-                    jets.append(np.asarray(jet))
-                    jet = []
-                else:
-                    jet.append(list(map(float, row)))
-
-    
-        return jets, jet_tots
+        jets = heppy.load_event_file(event_file_name(seed_number, particle_type, prefix, path),
+                                     cache = cache)
+
+        return jets, jets.jet_tots
+
+
+def iter_event_chunks(seed_number = 1, particle_type = '', prefix = '', path = '',
+                      chunk_size = 1000):
+
+    """ Streams the jets of a single event file produced by the Events.cc 
+    script, yielding heppy.JetCollections of chunk_size jets. Unlike 
+    data_import('event', ...), the file is never held in memory as a whole, 
+    so arbitrarily large files can be processed in constant memory.
+
+    seed_number: the seed of the file to read.
+    particle_type: the particle type of the file, e.g. 'gluon' or 'quark'.
+    prefix: the energy prefix of the file, e.g. '100GEV'.
+    path: path to directory with the files. Defaults to '../events'.
+    chunk_size: number of jets per chunk.
+    """
+
+    return heppy.iter_event_file(event_file_name(seed_number, particle_type, prefix, path), 
+                                 chunk_size = chunk_size)
+
+
+def event_file_name(seed_number = 1, particle_type = '', prefix = '', path = ''):
+
+    """ Returns the path of the event file produced by the Events.cc script
+    for the given seed, particle type and energy prefix. Plain .txt files are
+    preferred over compressed .txt.gz/.txt.bz2 ones.
+
+    path: path to directory with the files. Defaults to '../events'.
+    """
+
+    if len(path) == 0:
+        path = '../events'
+
+    filename = prefix + '-' + particle_type + '-event-seed' + str(seed_number)
+    return heppy.find_event_file(os.path.join(path, filename))
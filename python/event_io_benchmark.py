@@ -0,0 +1,53 @@
+# Benchmark comparing the wall time of reading plain and compressed event
+# files on a cold page cache.
+#
+# Usage: python3 event_io_benchmark.py ../events/100GEV-gluon-event-seed1.txt
+#
+# Compressed .txt.gz and .txt.bz2 copies of the given file are created next to
+# it if they don't exist yet. Before each read the file is dropped from the
+# page cache with posix_fadvise so that the timings include the disk (or
+# network filesystem) I/O.
+
+import heppy
+import bz2
+import gzip
+import os
+import shutil
+import sys
+import time
+
+n_trials = 3
+
+filename = sys.argv[1]
+assert filename.endswith('.txt'), 'Please give a plain .txt event file'
+
+# write the compressed copies
+for ext, opener in [('.gz', gzip.open), ('.bz2', bz2.open)]:
+    if not os.path.exists(filename + ext):
+        heppy.fprint('Writing {} ... '.format(filename + ext))
+        with open(filename, 'rb') as fin, opener(filename + ext, 'wb') as fout:
+            shutil.copyfileobj(fin, fout)
+        heppy.fprint('Done\n')
+
+def drop_from_page_cache(name):
+    with open(name, 'rb') as fh:
+        os.fsync(fh.fileno())
+        os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+print('{:<50} {:>10} {:>10} {:>10}'.format('file', 'size [MB]', 'read [s]', 'stream [s]'))
+for name in [filename, filename + '.gz', filename + '.bz2']:
+    read_times, stream_times = [], []
+    for trial in range(n_trials):
+        drop_from_page_cache(name)
+        ts = time.time()
+        jets = heppy.read_event_file(name)
+        read_times.append(time.time() - ts)
+
+        drop_from_page_cache(name)
+        ts = time.time()
+        for chunk in heppy.iter_event_file(name):
+            pass
+        stream_times.append(time.time() - ts)
+
+    print('{:<50} {:>10.1f} {:>10.3f} {:>10.3f}'.format(os.path.basename(name),
+          os.path.getsize(name)/1e6, min(read_times), min(stream_times)))
@@ -12,6 +12,7 @@ import matplotlib as mpl
 #if matplotlib.get_backend() != 'agg':
 #    matplotlib.use('agg')
 import matplotlib.pyplot as plt
+from .utils import atomic_write
 
 
 def ROC_from_model(model, X_test, Y_test, num_points = 1000):
@@ -41,33 +42,215 @@ def abstract_ROC(classifier, labels, num_points = 1000):
     two classes. Class 0 is assumed to be more likely when the value of the classifier is smaller and class 1 is assumed to be more likely when the 
     value of the classifier is larger.
 
+    The exact curve is computed with exact_ROC, using O(N) memory and 
+    O(N log N) time. 
+
     classifier: list, values of the classifier for each sample
     labels: list, class labels for each sample
-    num_points: number of thresholds to evaluate when constructing the ROC curve
+    num_points: the number of points the curve is resampled to, at evenly
+                spaced class 1 efficiencies by linear interpolation. If None,
+                the exact curve is returned with one point per distinct 
+                value of the classifier.
+
+    Returns (class0_eff, class1_eff) in order of increasing threshold, i.e.
+    of decreasing class 1 efficiency.
     """ 
 
-    # array for holding predictions based on the threshold
-    preds_by_thresh = np.zeros((num_points, len(labels)))
+    fpr, tpr, _ = exact_ROC(classifier, labels)
+    class0_eff, class1_eff = 1 - fpr[::-1], tpr[::-1]
 
-    anti_labels = 1 - labels
-    class1_count = np.sum(labels)
-    class0_count = len(labels) - class1_count
+    if num_points is None:
+        return class0_eff, class1_eff
 
-    dx = np.max([int(len(classifier) / num_points),1])
+    class1_grid = np.linspace(1, 0, num_points)
+    return 1 - _fpr_at_tpr(fpr, tpr, class1_grid), class1_grid
 
-    # iterate through linspace of thresholds
-    for i, thresh in enumerate(np.sort(classifier)[::dx]):
 
-        # make predictions based on classifier and threshold
-        preds_by_thresh[i, classifier > thresh] = 1
+def _fpr_at_tpr(fpr, tpr, class1_effs):
 
-    # compute fraction of class 1 we got correct for each threshold
-    class1_eff = np.dot(preds_by_thresh, labels)/class1_count
+    """ Linearly interpolates an exact ROC curve (fpr, tpr), as from 
+    exact_ROC, at the true positive rates class1_effs. """
 
-    # compute fraction of class 0 we got correct for each threshold
-    class0_eff = 1 - np.dot(preds_by_thresh, anti_labels)/class0_count
-    
-    return class0_eff, class1_eff
+    # a run of points with equal tpr is a horizontal stretch of the curve, so
+    # interpolate up to its first point from below and from its last point
+    # upwards. np.interp takes the rightmost of equal x values, so work with
+    # -tpr to get the first point (the lowest fpr) at the tpr of a run.
+    tprs, first = np.unique(tpr, return_index = True)
+    last = np.r_[first[1:] - 1, len(tpr) - 1]
+    fprs = np.stack([fpr[first], fpr[last]], axis = 1).reshape(-1)
+    return np.interp(-np.asarray(class1_effs), -np.repeat(tprs, 2)[::-1], fprs[::-1])
+
+
+def exact_ROC(classifier, labels):
+
+    """ Computes the exact ROC curve of a classifier in O(N log N) by sorting
+    the samples by classifier value and taking cumulative sums of the labels.
+    Samples with equal classifier values are collapsed into a single point.
+    The arguments are in the order of abstract_ROC, i.e. the reverse of
+    sklearn.metrics.roc_curve(labels, classifier), whose output conventions
+    it otherwise follows with class 1 as the positive class.
+
+    classifier: list, values of the classifier for each sample
+    labels: list, class labels (0 or 1) for each sample
+
+    Returns (fpr, tpr, thresholds), where fpr and tpr are the fractions of
+    class 0 and class 1 with classifier >= thresholds, in decreasing order 
+    of threshold and starting at (0, 0).
+    """
+
+    classifier, labels = np.asarray(classifier), np.asarray(labels)
+    if len(classifier) == 0:
+        return np.zeros(1), np.zeros(1), np.array([np.inf])
+    order = np.argsort(classifier, kind = 'mergesort')[::-1]
+    classifier, labels = classifier[order], labels[order]
+
+    # the last sample of every run of equal classifier values
+    last = np.r_[np.flatnonzero(np.diff(classifier)), len(classifier) - 1]
+    tps = np.cumsum(labels, dtype = np.float64)[last]
+    fps = last + 1 - tps
+
+    fpr = np.r_[0, fps] / max(fps[-1], 1)
+    tpr = np.r_[0, tps] / max(tps[-1], 1)
+    return fpr, tpr, np.r_[np.inf, classifier[last]]
+
+
+def _fpr_at_tpr_rows(fpr, tpr, class1_effs):
+
+    """ Interpolates each row of a batch of ROC curves, given as (n_curves,
+    n_points) arrays of nondecreasing fpr and tpr, at the true positive 
+    rates class1_effs. As for _fpr_at_tpr, the lowest fpr is taken at the 
+    tpr of a horizontal stretch. """
+
+    n_curves, n_points = tpr.shape
+    class1_effs = np.asarray(class1_effs, dtype = np.float64)
+
+    # one searchsorted for all rows, the offsets keep the rows apart
+    offsets = 2 * np.arange(n_curves)[:,np.newaxis]
+    above = np.searchsorted((tpr + offsets).reshape(-1), 
+                            (class1_effs + offsets).reshape(-1))
+    above = np.clip(above.reshape(n_curves, -1) - offsets // 2 * n_points, 
+                    0, n_points - 1)
+    below = np.maximum(above - 1, 0)
+
+    tpr_above = np.take_along_axis(tpr, above, axis = 1)
+    tpr_below = np.take_along_axis(tpr, below, axis = 1)
+    fpr_above = np.take_along_axis(fpr, above, axis = 1)
+    fpr_below = np.take_along_axis(fpr, below, axis = 1)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        fraction = np.clip((class1_effs - tpr_below) / (tpr_above - tpr_below), 0, 1)
+    fraction[tpr_above == tpr_below] = 1
+    return fpr_below + fraction * (fpr_above - fpr_below)
+
+
+def batch_ROC(scores, labels, efficiencies = [0.5], num_points = 1000,
+              min_eff = 0.05, reg = 10**-6, chunk_size = 16):
+
+    """ Computes the ROC curves and figures of merit of many classifiers at
+    once, e.g. the jet charges for a grid of kappas or the outputs of an
+    ensemble of networks. The classifiers are handled chunk_size at a time:
+    their scores are sorted in one call and the cumulative class counts of 
+    all of them are taken together, with the label totals shared.
+
+    scores: an (n_samples, n_scores) array with one classifier per column.
+            As for abstract_ROC, class 1 is more likely at larger values.
+    labels: class labels (0 or 1) for each sample.
+    efficiencies: the class 1 efficiencies to evaluate the rejection at.
+    num_points: the number of points of the returned curves, as for 
+                abstract_ROC. If None, the exact curves are returned as lists,
+                and if 0 no curves are returned.
+    min_eff: the smallest class 1 efficiency considered for the maximum 
+             significance improvement, which is dominated by statistical 
+             noise at very low efficiencies.
+    reg: the regulator of SI.
+
+    Returns a dict of arrays, column i belonging to scores[:,i]:
+    'auc': (n_scores,), the areas under the curves.
+    'rejection': (len(efficiencies), n_scores), the fraction of class 0
+                 rejected, 1 - fpr (= class0_eff), at each of efficiencies,
+                 interpolated along the curve. This is the 'rejection' of
+                 kappa_scan.
+    'max_SI', 'max_SI_eff': (n_scores,), the maximum of SI over class 1 
+                            efficiencies of at least min_eff and the 
+                            efficiency it is reached at.
+    'class0_eff', 'class1_eff': the curves in the convention of abstract_ROC,
+                                (num_points, n_scores) and (num_points,).
+    """
+
+    scores = np.asarray(scores)
+    if scores.ndim == 1:
+        scores = scores[:,np.newaxis]
+    labels = np.asarray(labels).reshape(-1)
+    if len(labels) != len(scores):
+        raise ValueError('Number of labels does not match number of samples')
+    n, n_scores = scores.shape
+    efficiencies = np.asarray(efficiencies, dtype = float).reshape(-1)
+
+    # shared by all of the classifiers
+    class1_count = max(np.sum(labels, dtype = np.float64), 1)
+    class0_count = max(n - np.sum(labels, dtype = np.float64), 1)
+    nb_seen = np.arange(1, n + 1, dtype = np.float64)
+    columns = np.arange(n)
+    class1_grid = None if not num_points else np.linspace(1, 0, num_points)
+
+    results = {'auc': np.zeros(n_scores), 
+               'rejection': np.zeros((len(efficiencies), n_scores)),
+               'max_SI': np.zeros(n_scores), 'max_SI_eff': np.zeros(n_scores)}
+    class0_effs, class1_effs = [], []
+
+    for start in range(0, n_scores, chunk_size):
+
+        # one row per classifier keeps the sorts and sums contiguous
+        chunk = np.ascontiguousarray(scores[:,start:start+chunk_size].T)
+        rows = slice(start, start + len(chunk))
+        order = np.argsort(chunk, axis = 1)[:,::-1]
+        sorted_scores = np.take_along_axis(chunk, order, axis = 1)
+        tps = np.cumsum(labels[order], axis = 1, dtype = np.float64)
+        fps = nb_seen - tps
+
+        # give every sample of a run of tied scores the counts at the end of
+        # the run, which turns the tied points into repeats of one point
+        is_last = np.ones(chunk.shape, dtype = bool)
+        is_last[:,:-1] = sorted_scores[:,1:] != sorted_scores[:,:-1]
+        if not np.all(is_last):
+            run_end = np.where(is_last, columns, n - 1)
+            run_end = np.minimum.accumulate(run_end[:,::-1], axis = 1)[:,::-1]
+            tps = np.take_along_axis(tps, run_end, axis = 1)
+            fps = np.take_along_axis(fps, run_end, axis = 1)
+
+        zeros = np.zeros((len(chunk), 1))
+        tpr = np.concatenate([zeros, tps / class1_count], axis = 1)
+        fpr = np.concatenate([zeros, fps / class0_count], axis = 1)
+
+        results['auc'][rows] = _trapezoid(tpr, fpr, axis = 1)
+        results['rejection'][:,rows] = 1 - _fpr_at_tpr_rows(fpr, tpr, 
+                                               np.tile(efficiencies, (len(chunk), 1))).T
+
+        si = np.where(tpr >= min_eff, tpr / np.sqrt(fpr + reg), -np.inf)
+        best = np.argmax(si, axis = 1)[:,np.newaxis]
+        results['max_SI'][rows] = np.take_along_axis(si, best, axis = 1)[:,0]
+        results['max_SI_eff'][rows] = np.take_along_axis(tpr, best, axis = 1)[:,0]
+
+        if num_points == 0:
+            continue
+        if class1_grid is not None:
+            class0_effs.append(1 - _fpr_at_tpr_rows(fpr, tpr, 
+                                       np.tile(class1_grid, (len(chunk), 1))))
+            continue
+        for fpr_i, tpr_i in zip(fpr, tpr):
+            # the distinct points of the curve
+            keep = np.r_[True, (tpr_i[1:] != tpr_i[:-1]) | (fpr_i[1:] != fpr_i[:-1])]
+            class0_effs.append(1 - fpr_i[keep][::-1])
+            class1_effs.append(tpr_i[keep][::-1])
+
+    if num_points == 0:
+        return results
+    if class1_grid is None:
+        results['class0_eff'], results['class1_eff'] = class0_effs, class1_effs
+    else:
+        results['class1_eff'] = class1_grid
+        results['class0_eff'] = np.concatenate(class0_effs).T if n_scores > 0 \
+                                else np.zeros((num_points, 0))
+    return results
 
 
 def save_ROC(model, X_test, Y_test, name, num_points = 1000, plot = False,
@@ -229,12 +412,29 @@ def plot_SI_Nvar(particle2_effs, particle1_effs, labels = '', title = '', xlim =
 
 
 
+def _trapezoid(y, x, axis = -1):
+
+    """ The trapezoid rule integral of y over x along axis, as np.trapz
+    (renamed np.trapezoid in numpy 2). """
+
+    y, x = np.asarray(y), np.asarray(x)
+    dx = np.diff(x, axis = axis)
+    upper = [slice(None)] * y.ndim
+    lower = [slice(None)] * y.ndim
+    upper[axis], lower[axis] = slice(1, None), slice(None, -1)
+    return np.sum(dx * (y[tuple(upper)] + y[tuple(lower)]), axis = axis) / 2
+
+
 def ROC_area(qe, ge):
 
     """ Compute area under the ROC curve """
 
-    normal_order = qe.argsort()
-    return np.trapz(ge[normal_order], qe[normal_order])
+    # points with equal qe (vertical stretches) are put in order along the
+    # curve, whose ge rises or falls with qe
+    qe, ge = np.asarray(qe), np.asarray(ge)
+    direction = 1 if np.sum((qe - np.mean(qe)) * (ge - np.mean(ge))) >= 0 else -1
+    normal_order = np.lexsort((direction * ge, qe))
+    return _trapezoid(ge[normal_order], qe[normal_order])
 
 
 def SI(quark_eff, gluon_eff, reg = 10**-6):
@@ -260,3 +460,126 @@ def gr_at_50_qe(quark_eff, gluon_eff):
 
     return 1 - gluon_eff[np.argmin(np.abs(quark_eff - 0.5))]
 
+
+
+def logit_edges(nb_bins = 10000, eps = 10**-7):
+
+    """ Bin edges covering [0, 1] that are evenly spaced in logit(p), so the
+    bins are finest near 0 and 1 where the outputs of a well trained sigmoid
+    or softmax pile up. eps sets the innermost bins, [0, eps] and [1-eps, 1].
+    """
+
+    logits = np.linspace(np.log(eps / (1 - eps)), np.log((1 - eps) / eps), 
+                         nb_bins - 1)
+    return np.r_[0, 1 / (1 + np.exp(-logits)), 1]
+
+
+class ROCAccumulator(object):
+
+    """ Accumulates a ROC curve over a stream of classifier outputs in 
+    constant memory. The (weighted) outputs of each class are histogrammed
+    with fixed bins, and accumulators with the same bins, e.g. filled with
+    different shards of a test set in different processes, can be merged 
+    exactly with merge. The curve is exact up to the bin width: samples
+    falling in the same bin are treated as ties.
+
+    nb_bins, low, high: evenly spaced bins covering [low, high]. Outputs
+                        outside of it are put into the first or last bin.
+    edges: if given, the bin edges to use instead, e.g. logit_edges or 
+           np.quantile of a first batch of outputs for bins adapted to the 
+           classifier.
+    """
+
+    def __init__(self, nb_bins = 10000, low = 0., high = 1., edges = None):
+
+        if edges is None:
+            edges = np.linspace(low, high, nb_bins + 1)
+        self.edges = np.asarray(edges, dtype = np.float64)
+        if len(self.edges) < 2 or np.any(np.diff(self.edges) <= 0):
+            raise ValueError('Bin edges must be increasing')
+        self.hists = np.zeros((2, len(self.edges) - 1))
+
+    def __repr__(self):
+        return 'ROCAccumulator({} bins, class weights {})'.format(
+               self.hists.shape[1], self.totals.tolist())
+
+    @property
+    def totals(self):
+
+        """ The total weight of each class. """
+
+        return np.sum(self.hists, axis = 1)
+
+    def update(self, classifier, labels, weights = None):
+
+        """ Adds a batch of classifier outputs, with class labels 0 or 1 and 
+        optional per-sample weights, and returns self. """
+
+        classifier = np.asarray(classifier).reshape(-1)
+        labels = np.asarray(labels).reshape(-1)
+        bins = np.clip(np.searchsorted(self.edges, classifier, side = 'right') - 1,
+                       0, self.hists.shape[1] - 1)
+        weights = np.ones(len(classifier)) if weights is None else \
+                  np.asarray(weights, dtype = np.float64).reshape(-1)
+
+        is_class1 = labels == 1
+        for c, selected in enumerate([~is_class1, is_class1]):
+            self.hists[c] += np.bincount(bins[selected], weights = weights[selected], 
+                                         minlength = self.hists.shape[1])
+        return self
+
+    def merge(self, other):
+
+        """ Adds the histograms of other into these ones and returns self. """
+
+        if not np.array_equal(self.edges, other.edges):
+            raise ValueError('Cannot merge ROC accumulators with different bins')
+        self.hists += other.hists
+        return self
+
+    def curve(self):
+
+        """ Returns (class0_eff, class1_eff) as from abstract_ROC, with one 
+        point per bin edge that has outputs below it, in order of increasing 
+        threshold. """
+
+        # the weight of each class above every bin edge, from the top down
+        above = np.zeros((2, self.hists.shape[1] + 1))
+        np.cumsum(self.hists[:,::-1], axis = 1, out = above[:,-2::-1])
+        keep = np.r_[True, np.any(self.hists != 0, axis = 0)]
+        totals = self.totals
+        totals[totals == 0] = 1
+        return (1 - above[0,keep] / totals[0]), above[1,keep] / totals[1]
+
+    def ROC_area(self):
+        class0_eff, class1_eff = self.curve()
+        return ROC_area(class1_eff, class0_eff)
+
+    def SI(self, reg = 10**-6):
+        class0_eff, class1_eff = self.curve()
+        return SI(class1_eff, class0_eff, reg)
+
+    def inv_ROC(self, reg = 10**-6):
+        class0_eff, class1_eff = self.curve()
+        return inv_ROC(class1_eff, class0_eff, reg)
+
+    def gr_at_50_qe(self):
+        class0_eff, class1_eff = self.curve()
+        return gr_at_50_qe(class1_eff, class0_eff)
+
+    def save(self, filename):
+
+        """ Saves the bins and histograms to a .npz file. """
+
+        with atomic_write(filename) as fh:
+            np.savez(fh, edges = self.edges, hists = self.hists)
+
+    @staticmethod
+    def load(filename):
+
+        """ Loads an accumulator saved with save. """
+
+        with np.load(filename) as data:
+            accumulator = ROCAccumulator(edges = data['edges'])
+            accumulator.hists[...] = data['hists']
+        return accumulator
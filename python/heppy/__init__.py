@@ -3,3 +3,10 @@ from .jet_RGB_images import *
 from .utils import *
 from .particle_tools import *
 from .jet_charge import *
+from .charges import *
+from .jet_collection import *
+from .event_io import *
+from .chunked_images import *
+from .image_stats import *
+from .augmentation import *
+from .sampling import *
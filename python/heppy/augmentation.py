@@ -0,0 +1,181 @@
+# Jet image augmentation by reflections and translations, done lazily.
+#
+# apply_jitter materializes every transformed copy of every image at once,
+# i.e. (n_jitter + 1) times the input, and then permutes all of them. Here
+# the augmented dataset is only virtual: sample v of it is transform v // n
+# applied to image v % n, in the same order as apply_jitter lays them out.
+# Each minibatch gathers its original images and applies the sampled
+# transforms to them, so memory stays at one copy of the dataset whatever
+# the number of transforms.
+
+import numpy as np
+
+__all__ = ['jitter_transforms', 'transform_images', 'JitterAugmenter']
+
+JITTER_TYPES = ['all', 'reflect', 'translate']
+
+
+def jitter_transforms(which = 'all', step = 1):
+
+    """ Returns the list of transforms used by apply_jitter, in its order.
+    Each transform is a tuple (flip_rap, flip_phi, shift_rap, shift_phi),
+    the first entry being the identity.
+
+    which: either 'all', 'reflect' or 'translate', as for apply_jitter.
+    step: the maximum translation, measured by the manhattan metric.
+    """
+
+    assert which in JITTER_TYPES, 'Invalid jittering'
+
+    transforms = [(False, False, 0, 0)]
+    if which == 'all' or which == 'reflect':
+        transforms += [(True, False, 0, 0), (False, True, 0, 0), (True, True, 0, 0)]
+    if which == 'all' or which == 'translate':
+        transforms += [(False, False, i, j)
+                       for i in range(-step, step + 1)
+                       for j in range(-step, step + 1)
+                       if 0 < abs(i) + abs(j) <= step]
+    return transforms
+
+
+def _shift_slices(shift, size):
+
+    """ The (target, source) slices translating an axis of length size by
+    shift pixels. """
+
+    if shift >= 0:
+        return slice(shift, size), slice(0, size - shift)
+    return slice(0, size + shift), slice(-shift, size)
+
+
+def transform_images(images, transform, out = None):
+
+    """ Applies a single transform from jitter_transforms to an array of
+    images of shape (nb_images, nb_chan, img_size, img_size). Pixels that a
+    translation moves in from outside the image are zero.
+
+    out: if given, the array the transformed images are written to. It must
+         not overlap with images.
+    """
+
+    flip_rap, flip_phi, shift_rap, shift_phi = transform
+    if out is None:
+        out = np.empty_like(images)
+
+    view = images[:,:,::-1 if flip_rap else 1,::-1 if flip_phi else 1]
+    if shift_rap == 0 and shift_phi == 0:
+        out[...] = view
+        return out
+
+    out[...] = 0
+    target_i, source_i = _shift_slices(shift_rap, images.shape[2])
+    target_j, source_j = _shift_slices(shift_phi, images.shape[3])
+    out[:,:,target_i,target_j] = view[:,:,source_i,source_j]
+    return out
+
+
+class JitterAugmenter(object):
+
+    """ Produces minibatches of jittered images on demand from the original
+    images, as an endless generator suitable for Keras' fit_generator.
+
+    X: the images, an array of shape (nb_images, nb_chan, img_size, img_size)
+       or anything indexable by arrays of rows, e.g. a memory map or the lazy
+       views of data_split.
+    Y: if given, the labels paired with X, returned along with the images.
+    which, step: the transforms to use, see jitter_transforms.
+    batch_size: the number of images in a minibatch.
+    mode: 'epoch' - each epoch goes through every (image, transform) pair
+                    exactly once, exactly like training on apply_jitter.
+          'random' - every minibatch draws images and transforms uniformly.
+    shuffle: in 'epoch' mode, whether the pairs are shuffled every epoch.
+    seed: if given, the sequence of minibatches is reproducible.
+    dtype: the dtype of the returned images.
+    """
+
+    def __init__(self, X, Y = None, which = 'all', step = 1, batch_size = 128,
+                 mode = 'epoch', shuffle = True, seed = None, dtype = np.float32):
+
+        assert mode in ['epoch', 'random'], 'Invalid augmentation mode'
+        if Y is not None and len(Y) != len(X):
+            raise ValueError('X and Y have different lengths')
+
+        self.X, self.Y = X, Y
+        self.transforms = jitter_transforms(which, step)
+        self.batch_size = batch_size
+        self.mode, self.shuffle = mode, shuffle
+        self.dtype = dtype
+        self.rng = np.random.RandomState(seed)
+
+    @property
+    def nb_samples(self):
+
+        """ The size of the virtual augmented dataset. """
+
+        return len(self.X) * len(self.transforms)
+
+    def __len__(self):
+
+        """ The number of minibatches per epoch, e.g. for steps_per_epoch. """
+
+        return -(-self.nb_samples // self.batch_size)
+
+    def batch(self, rows, transform_ids):
+
+        """ Returns the images at rows with the transforms transform_ids
+        applied (and their labels if Y was given). The images are gathered in
+        increasing order of rows, which is kinder to memory-mapped data, and
+        the batch is returned in that order. """
+
+        order = np.argsort(rows, kind = 'stable')
+        rows, transform_ids = rows[order], transform_ids[order]
+        images = np.asarray(self.X[rows], dtype = self.dtype)
+
+        out = np.empty_like(images)
+        for t in np.unique(transform_ids):
+            selected = np.flatnonzero(transform_ids == t)
+            out[selected] = transform_images(images[selected], self.transforms[t])
+
+        if self.Y is None:
+            return out
+        return out, np.asarray(self.Y[rows])
+
+    def epoch_tasks(self):
+
+        """ Yields the (rows, transform_ids) of the minibatches of one epoch,
+        to be turned into minibatches with batch. """
+
+        n = len(self.X)
+        if self.mode == 'random':
+            for start in range(0, self.nb_samples, self.batch_size):
+                size = min(self.batch_size, self.nb_samples - start)
+                yield self.rng.randint(n, size = size), \
+                      self.rng.randint(len(self.transforms), size = size)
+            return
+
+        order = self.rng.permutation(self.nb_samples) if self.shuffle \
+                else np.arange(self.nb_samples)
+        for start in range(0, self.nb_samples, self.batch_size):
+            samples = order[start:start+self.batch_size]
+            yield samples % n, samples // n
+
+    def tasks(self):
+
+        """ Yields the (rows, transform_ids) of the minibatches of endless
+        epochs, e.g. for a keras_helpers.Prefetcher building them with
+        batch. """
+
+        while True:
+            for task in self.epoch_tasks():
+                yield task
+
+    def epoch(self):
+
+        """ Yields the minibatches of one epoch. """
+
+        for rows, transform_ids in self.epoch_tasks():
+            yield self.batch(rows, transform_ids)
+
+    def __iter__(self):
+        for rows, transform_ids in self.tasks():
+            yield self.batch(rows, transform_ids)
@@ -0,0 +1,68 @@
+# Charges of the final state particles, looked up from their PDG ids.
+#
+# charge_map is the reference mapping. For speed, it is compiled into a dense
+# table indexed by particle id so that a whole column of ids is converted to
+# charges with a single indexing operation rather than one dictionary lookup
+# per particle.
+
+import numpy as np
+
+__all__ = ['charge_map', 'pdg_charges', 'set_unknown_charge_policy']
+
+# mapping from particle id to charge of the particle
+charge_map = {11: -1, -11:  1, 13: -1, -13:  1, 22:  0, -22:  0,
+              111:  0, -111:  0, 130:  0, -130:  0, 211:  1, -211: -1,
+              321:  1, -321: -1, 2112:  0, -2112:  0, 2212:  1, -2212: -1}
+
+# what to do with particle ids missing from charge_map:
+#   'raise' - raise a KeyError, as a lookup in charge_map would
+#   'zero'  - treat the particle as neutral
+#   'nan'   - return nan as its charge
+UNKNOWN_CHARGE_POLICIES = ['raise', 'zero', 'nan']
+_unknown_policy = 'raise'
+
+# the table covers ids -_max_id to _max_id, the extra last entry is a nan
+# that every id outside of this range is sent to
+_max_id = max(abs(pdgid) for pdgid in charge_map)
+_charge_table = np.full(2 * _max_id + 2, np.nan)
+_charge_table[np.asarray(list(charge_map)) + _max_id] = list(charge_map.values())
+
+
+def set_unknown_charge_policy(policy):
+
+    """ Sets how pdg_charges treats particle ids it doesn't know by default,
+    see UNKNOWN_CHARGE_POLICIES. """
+
+    global _unknown_policy
+    assert policy in UNKNOWN_CHARGE_POLICIES, 'Invalid unknown charge policy'
+    _unknown_policy = policy
+
+
+def pdg_charges(pdgids, unknown = ''):
+
+    """ Returns the charges of an array of particle ids as a float array.
+
+    pdgids: an array (or scalar) of PDG particle ids, possibly stored as
+            floats as in the particle tables.
+    unknown: one of UNKNOWN_CHARGE_POLICIES deciding what to do with ids that
+             are not in charge_map. Defaults to the policy set with
+             set_unknown_charge_policy, which is initially 'raise'.
+    """
+
+    policy = unknown if len(unknown) > 0 else _unknown_policy
+    assert policy in UNKNOWN_CHARGE_POLICIES, 'Invalid unknown charge policy'
+
+    pdgids = np.asarray(pdgids)
+    indices = pdgids.astype(np.int64).reshape(-1) + _max_id
+    indices[(indices < 0) | (indices >= len(_charge_table))] = -1
+    charges = _charge_table[indices]
+
+    if policy != 'nan':
+        unknown_mask = np.isnan(charges)
+        if np.any(unknown_mask):
+            if policy == 'raise':
+                raise KeyError('Unknown particle id {} in charge lookup'.format(
+                               pdgids.reshape(-1)[unknown_mask][0]))
+            charges[unknown_mask] = 0
+
+    return charges.reshape(pdgids.shape)
@@ -0,0 +1,201 @@
+# A compressed container for jet images that allows random access.
+#
+# np.savez_compressed writes all of the images as one zlib stream, so reading
+# any image means decompressing the whole file. Here the images are instead
+# split into blocks of block_size images which are compressed independently,
+# and an index of where each block starts is kept at the end of the file.
+# Reading a list of images, e.g. a shuffled minibatch, only decompresses the
+# blocks that are touched. Recently used blocks are kept in an LRU cache and
+# missing blocks are decompressed in a thread pool, which runs in parallel
+# since zlib releases the GIL.
+#
+# File layout: the compressed blocks one after the other, then a JSON trailer
+# with the shape, dtype, block size and block offsets, then the length of the
+# trailer as 8 little-endian bytes.
+
+import numpy as np
+import json
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from .utils import atomic_write
+
+__all__ = ['ChunkedImageFile', 'write_chunked_images']
+
+CHUNKED_FORMAT = 'heppy-chunked-images'
+CHUNKED_VERSION = 1
+TRAILER_LEN_BYTES = 8
+
+
+def _trailer_bytes(shape, dtype, block_size, offsets, level):
+
+    trailer = json.dumps({'format': CHUNKED_FORMAT, 'version': CHUNKED_VERSION,
+                          'shape': list(shape), 'dtype': np.dtype(dtype).str,
+                          'block_size': block_size, 'level': level,
+                          'offsets': [int(o) for o in offsets]}).encode()
+    return trailer + len(trailer).to_bytes(TRAILER_LEN_BYTES, 'little')
+
+
+def write_chunked_images(filename, images, block_size = 256, level = 6,
+                         n_threads = None):
+
+    """ Writes an array of images to a chunked compressed file.
+
+    filename: the file to write.
+    images: the array of images, of shape (nb_images, ...).
+    block_size: the number of images compressed together. Smaller blocks
+                make random reads cheaper, larger ones compress better.
+    level: the zlib compression level.
+    n_threads: the number of threads compressing blocks. Defaults to the
+               number of cores.
+    """
+
+    assert block_size > 0, 'block_size must be positive'
+    images = np.asarray(images)
+    starts = range(0, len(images), block_size)
+
+    def compress(start):
+        return zlib.compress(np.ascontiguousarray(images[start:start+block_size]),
+                             level)
+
+    offsets = [0]
+    with atomic_write(filename) as fh, \
+         ThreadPoolExecutor(n_threads or os.cpu_count() or 1) as pool:
+        for block in pool.map(compress, starts):
+            fh.write(block)
+            offsets.append(offsets[-1] + len(block))
+        fh.write(_trailer_bytes(images.shape, images.dtype, block_size, offsets,
+                                level))
+
+
+class ChunkedImageFile(object):
+
+    """ Random access reader of a file written by write_chunked_images.
+
+    filename: the file to read.
+    cache_blocks: the number of decompressed blocks kept in the LRU cache.
+    n_threads: the number of threads decompressing blocks. Defaults to the
+               number of cores.
+
+    Images are read with read(indices) or by indexing, e.g. f[batch] for an
+    array of indices or f[100:200], and are returned in the requested order.
+    """
+
+    def __init__(self, filename, cache_blocks = 64, n_threads = None):
+
+        self.filename = filename
+        self.cache_blocks = cache_blocks
+        self._fd = os.open(filename, os.O_RDONLY)
+        try:
+            self._read_trailer()
+        except Exception:
+            os.close(self._fd)
+            raise
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(n_threads or os.cpu_count() or 1)
+
+    def _read_trailer(self):
+
+        size = os.fstat(self._fd).st_size
+        length = int.from_bytes(os.pread(self._fd, TRAILER_LEN_BYTES,
+                                         size - TRAILER_LEN_BYTES), 'little')
+        start = size - TRAILER_LEN_BYTES - length
+        try:
+            trailer = json.loads(os.pread(self._fd, length, start).decode())
+        except (ValueError, UnicodeDecodeError):
+            raise ValueError('{} is not a chunked image file'.format(self.filename))
+        if trailer.get('format') != CHUNKED_FORMAT or \
+           trailer.get('version') != CHUNKED_VERSION:
+            raise ValueError('{} is not a supported chunked image file'.format(
+                             self.filename))
+
+        self.shape = tuple(trailer['shape'])
+        self.dtype = np.dtype(trailer['dtype'])
+        self.block_size = trailer['block_size']
+        self.offsets = np.asarray(trailer['offsets'], dtype = np.int64)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.read([key])[0]
+        return self.read(np.arange(len(self))[key])
+
+    def close(self):
+        if self._fd is not None:
+            self._pool.shutdown()
+            os.close(self._fd)
+            self._fd = None
+
+    @property
+    def nb_blocks(self):
+        return len(self.offsets) - 1
+
+    def _decompress(self, block):
+
+        """ Reads and decompresses a block, bypassing the cache. """
+
+        start, stop = self.offsets[block], self.offsets[block+1]
+        data = zlib.decompress(os.pread(self._fd, int(stop - start), int(start)))
+        return np.frombuffer(data, dtype = self.dtype).reshape((-1,) + self.shape[1:])
+
+    def read_blocks(self, blocks):
+
+        """ Returns a dict from block number to the decompressed (read-only)
+        images of that block, decompressing the blocks missing from the cache
+        in the thread pool. """
+
+        blocks = [int(b) for b in blocks]
+        with self._lock:
+            found = {b: self._cache[b] for b in blocks if b in self._cache}
+            for b in found:
+                self._cache.move_to_end(b)
+        missing = [b for b in blocks if b not in found]
+        found.update(zip(missing, self._pool.map(self._decompress, missing)))
+
+        with self._lock:
+            for b in missing:
+                self._cache[b] = found[b]
+            while len(self._cache) > self.cache_blocks:
+                self._cache.popitem(last = False)
+        return found
+
+    def read(self, indices, out = None):
+
+        """ Returns the images at indices, in that order.
+
+        indices: an array of image indices.
+        out: if given, an array of shape (len(indices),) + image shape that
+             the images are written into.
+        """
+
+        indices = np.asarray(indices, dtype = np.int64).reshape(-1)
+        if np.any((indices < 0) | (indices >= len(self))):
+            raise IndexError('Image index out of range')
+        if out is None:
+            out = np.empty((len(indices),) + self.shape[1:], dtype = self.dtype)
+
+        block_ids = indices // self.block_size
+        blocks = self.read_blocks(np.unique(block_ids))
+        for b, images in blocks.items():
+            selected = np.flatnonzero(block_ids == b)
+            out[selected] = images[indices[selected] - b * self.block_size]
+        return out
+
+    def iter_blocks(self):
+
+        """ Yields the images of the file block by block, in order, without
+        filling the cache. """
+
+        for block in range(self.nb_blocks):
+            yield self._decompress(block)
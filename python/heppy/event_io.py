@@ -0,0 +1,340 @@
+# Fast readers for the event files written by Events.cc and events_lh.cc.
+#
+# The files are csv style with comments beginning with a '#', one line per
+# jet of the form 'Event #, [jet_rap], [jet_phi], [jet_pt]', one line per
+# particle of the form '[rap], [phi], [pt], [pdgid]', and an empty line
+# closing each jet. Rather than going through the file row by row, the lines
+# are classified all at once with numpy and every number in the file is
+# converted with a single call, giving a flat particle table together with
+# per-jet offsets, i.e. a JetCollection.
+#
+# Since the same event files are read over and over again, the parsed tables
+# can also be cached on disk as .npy files next to the event file. These are
+# memory-mapped when loaded, which makes reloading nearly instant and lets
+# several processes on a node share the same pages.
+#
+# For files too large to hold in memory, iter_event_file reads the file block
+# by block and yields fixed size chunks of jets as they are completed.
+#
+# Like CleverOFStream on the C++ side, files ending in .gz or .bz2 are
+# transparently decompressed while they are read.
+
+import numpy as np
+import bz2
+import gzip
+import json
+import multiprocessing
+import os
+from .jet_collection import JetCollection, concatenate_jets
+from .utils import atomic_write
+
+__all__ = ['read_event_file', 'parse_event_bytes', 'load_event_file',
+           'load_event_files', 'iter_event_file', 'open_event_file', 
+           'find_event_file']
+
+# bump whenever the layout of the cached arrays changes
+CACHE_VERSION = 1
+CACHE_ARRAYS = ['particles', 'offsets', 'jet_tots']
+
+# both particle lines and jet header lines (counting the event number) have
+# four comma separated values
+NB_COLS = 4
+
+_NEWLINE = ord('\n')
+_RETURN = ord('\r')
+_COMMA = ord(',')
+_SPACE = ord(' ')
+_COMMENT = ord('#')
+_HEADER = b'Event'
+
+# number of bytes read at a time when streaming an event file
+BLOCK_SIZE = 1 << 22
+
+# the extensions an event file may have, in order of preference
+EVENT_FILE_EXTENSIONS = ['.txt', '.txt.gz', '.txt.bz2']
+
+
+def parse_event_bytes(data, final = True):
+
+    """ Parses the contents of an event file in a single vectorized pass.
+
+    data: the raw bytes of (part of) an event file.
+    final: if False, data may end in the middle of a jet and everything after
+           the last complete jet is left unparsed.
+
+    Returns (particles, offsets, jet_tots, nb_consumed) where particles is an
+    (nb_particles, 4) array of (rap, phi, pt, pdgid), the particles of jet i
+    are particles[offsets[i]:offsets[i+1]], jet_tots is an (nb_jets, 3) array
+    of (jet_rap, jet_phi, jet_pt), and nb_consumed is the number of bytes of
+    data that were used. Anything following the last empty line is not part
+    of a complete jet and is dropped.
+    """
+
+    buf = np.frombuffer(data, dtype = np.uint8)
+
+    # locate the lines, only keeping the part of data up to the last empty line
+    ends = np.flatnonzero(buf == _NEWLINE)
+    starts = np.empty_like(ends)
+    starts[:1] = 0
+    starts[1:] = ends[:-1] + 1
+    text_ends = ends - ((ends > starts) & (buf[ends - 1] == _RETURN))
+    is_blank = text_ends == starts
+
+    nb_jets = int(np.count_nonzero(is_blank))
+    if nb_jets == 0:
+        return (np.zeros((0, NB_COLS)), np.zeros(1, dtype = np.int64),
+                np.zeros((0, NB_COLS - 1)), len(data) if final else 0)
+    nb_lines = np.flatnonzero(is_blank)[-1] + 1
+    nb_consumed = int(ends[nb_lines - 1]) + 1
+    ends, starts, is_blank = ends[:nb_lines], starts[:nb_lines], is_blank[:nb_lines]
+
+    # classify the lines by their first character
+    first = buf[starts]
+    is_comment = first == _COMMENT
+    is_header = first == _HEADER[0]
+    is_particle = ~(is_blank | is_comment | is_header)
+
+    counts = np.bincount((np.cumsum(is_blank) - is_blank)[is_particle],
+                         minlength = nb_jets)
+    offsets = np.zeros(nb_jets + 1, dtype = np.int64)
+    np.cumsum(counts, out = offsets[1:])
+
+    # turn the data into a single comma separated list of numbers: the line
+    # endings become separators, while 'Event', comments and blank lines
+    # become whitespace, which is ignored by the conversion
+    text = bytearray(data[:nb_consumed])
+    chars = np.frombuffer(text, dtype = np.uint8)
+    header_starts = starts[is_header]
+    prefix = header_starts[:,np.newaxis] + np.arange(len(_HEADER))
+    if np.any(chars[np.minimum(prefix, nb_consumed - 1)] !=
+              np.frombuffer(_HEADER, dtype = np.uint8)):
+        raise ValueError('Malformed event file: bad jet header line')
+    chars[prefix] = _SPACE
+    chars[ends] = _COMMA
+    chars[ends[is_blank]] = _SPACE
+    if np.any(is_comment):
+        last = np.flatnonzero(is_comment)[-1] + 1
+        chars[:ends[last - 1] + 1][np.repeat(is_comment[:last],
+                                   (ends - starts + 1)[:last])] = _SPACE
+
+    nb_rows = len(starts) - nb_jets - int(np.count_nonzero(is_comment))
+    values = np.fromstring(bytes(text[:text.rfind(b',') + 1]), sep = ',')
+    if values.size != nb_rows * NB_COLS:
+        raise ValueError('Malformed event file: expected {} values, read {}'
+                         .format(nb_rows * NB_COLS, values.size))
+    rows = values.reshape((nb_rows, NB_COLS))
+
+    # split the rows back into particles and jet headers
+    is_header_row = is_header[~(is_blank | is_comment)]
+    particles = rows[~is_header_row]
+    jet_tots = rows[is_header_row, 1:]
+
+    return particles, offsets, jet_tots, len(data) if final else nb_consumed
+
+
+def open_event_file(filename):
+
+    """ Opens an event file for reading in binary mode, decompressing it on
+    the fly if its name ends in .gz or .bz2. """
+
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    elif filename.endswith('.bz2'):
+        return bz2.open(filename, 'rb')
+    else:
+        return open(filename, 'rb')
+
+
+def find_event_file(base_name):
+
+    """ Returns base_name with the first of the extensions .txt, .txt.gz and
+    .txt.bz2 for which the file exists. """
+
+    for ext in EVENT_FILE_EXTENSIONS:
+        if os.path.exists(base_name + ext):
+            return base_name + ext
+    raise FileNotFoundError('No event file {}[{}]'.format(base_name, 
+                            '|'.join(EVENT_FILE_EXTENSIONS)))
+
+
+def read_event_file(filename):
+
+    """ Reads an entire event file into a JetCollection.
+
+    filename: the path of the event file, possibly compressed.
+    """
+
+    with open_event_file(filename) as fh:
+        data = fh.read()
+    particles, offsets, jet_tots, _ = parse_event_bytes(data)
+    return JetCollection(particles, offsets, jet_tots)
+
+
+def iter_event_file(filename, chunk_size = 1000, block_size = BLOCK_SIZE):
+
+    """ Streams an event file, yielding JetCollections of chunk_size jets (the
+    last one may be smaller). Only about one chunk of jets and one block of
+    the file are held in memory at a time, independent of the file size.
+
+    filename: the path of the event file, possibly compressed.
+    chunk_size: the number of jets per yielded JetCollection.
+    block_size: the number of (uncompressed) bytes to read from the file at a
+                time.
+    """
+
+    assert chunk_size > 0, 'chunk_size must be positive'
+
+    pending, nb_pending = [], 0
+    remainder = b''
+    with open_event_file(filename) as fh:
+        final = False
+        while not final:
+            block = fh.read(block_size)
+            final = len(block) == 0
+            data = remainder + block
+            particles, offsets, jet_tots, nb_used = parse_event_bytes(data, final)
+            remainder = data[nb_used:]
+
+            if len(offsets) > 1:
+                pending.append(JetCollection(particles, offsets, jet_tots))
+                nb_pending += len(offsets) - 1
+
+            # hand out all the complete chunks we have
+            while nb_pending >= chunk_size:
+                jets = concatenate_jets(pending) if len(pending) > 1 else pending[0]
+                yield jets[:chunk_size]
+                pending, nb_pending = [jets[chunk_size:]], nb_pending - chunk_size
+
+    if nb_pending > 0:
+        yield concatenate_jets(pending)
+
+
+def _cache_files(filename, cache_dir):
+
+    """ Returns the names of the cached arrays and of the metadata file for
+    the event file filename. """
+
+    if len(cache_dir) == 0:
+        cache_dir = os.path.join(os.path.dirname(filename), '.event_cache')
+    base = os.path.join(cache_dir, os.path.basename(filename))
+    return {name: base + '.' + name + '.npy' for name in CACHE_ARRAYS}, \
+           base + '.meta.json'
+
+
+def _source_info(filename):
+
+    """ The properties of the event file that the cache is keyed on. """
+
+    stat = os.stat(filename)
+    return {'version': CACHE_VERSION, 'source': os.path.abspath(filename),
+            'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def _write_cache(jets, array_files, meta_file, info):
+
+    """ Writes the arrays of jets and then the metadata to the cache. Each
+    file is written under a temporary name and then moved into place, and
+    the metadata goes last, so a cache is only ever seen complete. """
+
+    os.makedirs(os.path.dirname(meta_file), exist_ok = True)
+    for name, array_file in array_files.items():
+        with atomic_write(array_file) as fh:
+            np.save(fh, getattr(jets, name))
+    with atomic_write(meta_file, 'w') as fh:
+        json.dump(info, fh)
+
+
+def _read_cache(filename, cache_dir):
+
+    """ Returns the memory-mapped jets of filename from the cache, or None if
+    there is no valid cache for it. """
+
+    array_files, meta_file = _cache_files(filename, cache_dir)
+    try:
+        with open(meta_file, 'r') as fh:
+            if json.load(fh) != _source_info(filename):
+                return None
+        return JetCollection(**{name: np.load(array_file, mmap_mode = 'r')
+                                for name, array_file in array_files.items()})
+    except (OSError, ValueError):
+        return None
+
+
+def load_event_file(filename, cache = True, cache_dir = ''):
+
+    """ Loads an event file into a JetCollection, going through the binary
+    cache when possible. The cache is considered valid only if the path, size
+    and modification time of the event file match the ones it was built from,
+    otherwise the event file is parsed again and the cache rebuilt. Jets
+    loaded from the cache are read-only memory maps.
+
+    filename: the path of the event file.
+    cache: if False, always parse the event file and don't touch the cache.
+    cache_dir: the directory holding the cache. Defaults to a .event_cache
+               directory next to the event file.
+    """
+
+    if not cache:
+        return read_event_file(filename)
+
+    jets = _read_cache(filename, cache_dir)
+    if jets is not None:
+        return jets
+
+    # the source is stat'ed before reading, so a file modified while we parse
+    # it leaves behind a cache that is already out of date
+    info = _source_info(filename)
+    jets = read_event_file(filename)
+    try:
+        _write_cache(jets, *_cache_files(filename, cache_dir), info = info)
+    except OSError:
+        # e.g. a read-only directory, we can still use the parsed jets
+        pass
+
+    return jets
+
+
+def _load_in_worker(args):
+
+    """ Loads one event file in a worker process. If the jets made it into
+    the cache, the parent can memory-map them itself and we return None
+    rather than sending the whole particle table back through a pipe. """
+
+    filename, cache, cache_dir = args
+    jets = load_event_file(filename, cache = cache, cache_dir = cache_dir)
+    if cache and _read_cache(filename, cache_dir) is not None:
+        return None
+    return jets
+
+
+def load_event_files(filenames, n_workers = None, cache = True, cache_dir = ''):
+
+    """ Loads several event files into a single JetCollection, with the jets
+    in the order of filenames. The files are parsed in parallel by a pool of 
+    worker processes and the result is assembled into one preallocated 
+    particle table.
+
+    filenames: the paths of the event files.
+    n_workers: the number of worker processes. Defaults to the number of
+               cores, 1 loads the files serially in this process.
+    cache: whether to go through the binary cache, see load_event_file.
+    cache_dir: the directory holding the cache, see load_event_file.
+    """
+
+    filenames = list(filenames)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = max(min(n_workers, len(filenames)), 1)
+
+    if n_workers == 1:
+        return concatenate_jets([load_event_file(f, cache, cache_dir) 
+                                 for f in filenames])
+
+    # Pool.map keeps the results in the order of filenames
+    with multiprocessing.Pool(n_workers) as pool:
+        results = pool.map(_load_in_worker, [(f, cache, cache_dir) 
+                                             for f in filenames], chunksize = 1)
+
+    return concatenate_jets([load_event_file(f, cache, cache_dir) 
+                             if jets is None else jets
+                             for f, jets in zip(filenames, results)])
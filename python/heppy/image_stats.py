@@ -0,0 +1,172 @@
+# Per-pixel statistics of jet images computed in a single streaming pass.
+#
+# zero_center and standardize need the mean and standard deviation of every
+# pixel of the training images. Rather than calling np.mean and np.std on the
+# whole array, which forces it into memory and allocates temporaries of the
+# same size, the images are visited chunk by chunk. The mean and the sum of
+# squared deviations (M2) of each chunk are combined with the running totals
+# using the pairwise update of Chan et al., a generalization of Welford's
+# algorithm which is numerically stable and also lets the statistics of
+# different parts of a dataset, e.g. computed by different workers, be merged
+# exactly.
+
+import numpy as np
+import json
+from .utils import atomic_write, parg
+
+__all__ = ['ImageStats', 'compute_image_stats', 'normalize_images']
+
+
+class ImageStats(object):
+
+    """ Running per-pixel count, mean and M2 of a stream of images, all kept
+    in float64. Add images with update and combine with the statistics of
+    other images with merge. """
+
+    def __init__(self, count = 0, mean = None, m2 = None):
+
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    def __repr__(self):
+        shape = None if self.mean is None else self.mean.shape
+        return 'ImageStats({} images of shape {})'.format(self.count, shape)
+
+    def update(self, images):
+
+        """ Adds an array of images of shape (nb_images,) + image shape. """
+
+        if len(images) == 0:
+            return self
+        images = np.asarray(images)
+        mean = np.mean(images, axis = 0, dtype = np.float64)
+        deviations = images - mean
+        m2 = np.einsum('i...,i...->...', deviations, deviations,
+                       dtype = np.float64)
+        return self.merge(ImageStats(len(images), mean, m2))
+
+    def merge(self, other):
+
+        """ Combines the statistics of other into these ones and returns
+        self. """
+
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count = other.count
+            self.mean, self.m2 = np.array(other.mean), np.array(other.m2)
+            return self
+        if self.mean.shape != other.mean.shape:
+            raise ValueError('Cannot merge statistics of images of different shapes')
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * (other.count / count)
+        self.m2 += other.m2 + delta**2 * (self.count * other.count / count)
+        self.count = count
+        return self
+
+    @property
+    def variance(self):
+
+        """ The per-pixel (population) variance. """
+
+        return self.m2 / self.count
+
+    @property
+    def std(self):
+
+        """ The per-pixel (population) standard deviation, as from np.std. """
+
+        return np.sqrt(self.variance)
+
+    def save(self, filename, key = {}):
+
+        """ Saves the statistics to a .npz file, together with a JSON 
+        serializable key describing what they were computed from. """
+
+        with atomic_write(filename) as fh:
+            np.savez(fh, count = self.count, mean = self.mean, m2 = self.m2, 
+                     key = json.dumps(key, sort_keys = True))
+
+    @staticmethod
+    def load(filename, key = {}):
+
+        """ Loads statistics saved with save, or returns None if there are
+        none or they were saved with a different key. """
+
+        try:
+            with np.load(filename) as data:
+                if str(data['key']) != json.dumps(key, sort_keys = True):
+                    return None
+                return ImageStats(int(data['count']), data['mean'], data['m2'])
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+def compute_image_stats(images, chunk_size = 10000):
+
+    """ Computes the ImageStats of images in a single pass over chunks of
+    chunk_size images, so images may be a memory-mapped array larger than
+    memory. images may also be an iterable of batches of images, e.g. from a
+    streaming reader. """
+
+    stats = ImageStats()
+    if hasattr(images, '__len__') and hasattr(images, '__getitem__'):
+        for start in range(0, len(images), chunk_size):
+            stats.update(images[start:start+chunk_size])
+    else:
+        for batch in images:
+            stats.update(batch)
+    return stats
+
+
+def normalize_images(images, mean = None, std = None, channels = [],
+                     chunk_size = 10000, out = None):
+
+    """ Subtracts mean from and then divides by std the given channels of the
+    images, in place and chunk_size images at a time, so that no temporary
+    larger than a chunk is needed.
+
+    images: an array of shape (nb_images, nb_chan, img_size, img_size),
+            possibly memory-mapped.
+    mean: the per-pixel mean to subtract, e.g. ImageStats.mean. If None,
+          nothing is subtracted.
+    std: the per-pixel standard deviation to divide by. If None, nothing is
+         divided by.
+    channels: which channels to normalize. The default will lead to all
+              channels being affected.
+    out: if given, an array of the same shape that the normalized images are
+         written to, leaving images untouched (e.g. if it's read-only).
+
+    Returns the normalized images, i.e. images or out.
+    """
+
+    if out is None:
+        out = images
+    elif out.shape != images.shape:
+        raise ValueError('out has shape {}, expected {}'.format(out.shape, images.shape))
+
+    if len(parg(channels)) == 0:
+        channels = np.arange(images.shape[1])
+    else:
+        channels = parg(channels)
+
+    # converting once keeps the chunks in the dtype of out
+    if mean is not None:
+        mean = np.asarray(mean)[channels].astype(out.dtype)
+    if std is not None:
+        std = np.asarray(std)[channels].astype(out.dtype)
+
+    for start in range(0, len(images), chunk_size):
+        chunk = out[start:start+chunk_size]
+        if out is not images:
+            chunk[...] = images[start:start+chunk_size]
+        for i, chan in enumerate(channels):
+            if mean is not None:
+                chunk[:,chan] -= mean[i]
+            if std is not None:
+                chunk[:,chan] /= std[i]
+
+    return out
@@ -3,17 +3,20 @@
 # Contains several useful functions for creating/modifying jet images.
 
 from .utils import *
+from .jet_collection import JetCollection, jets_from_list
+from .charges import charge_map, pdg_charges
+from .image_stats import ImageStats, compute_image_stats, normalize_images
+from .augmentation import jitter_transforms, transform_images
+import zlib
 from time import clock
+import json
+import mmap
+import multiprocessing
 #from keras.preprocessing.image import ImageDataGenerator
 
-# mapping from particle id to charge of the particle 
-charge_map = {11: -1, -11:  1, 13: -1, -13:  1, 22:  0, -22:  0, 
-              111:  0, -111:  0, 130:  0, -130:  0, 211:  1, -211: -1, 
-              321:  1, -321: -1, 2112:  0, -2112:  0, 2212:  1, -2212: -1}
-
 
 def pixelate(jet, charge_image = False, K = 0, K_two = 0, jet_center = [], img_size = 33, img_width = 0.8, nb_chan = 1, norm = True, 
-             rap_i=0, phi_i=1, pT_i=2, centers = False):
+             rap_i=0, phi_i=1, pT_i=2, centers = False, dtype = np.float32):
 
     """ A function for creating a jet image from a list of particles.
 
@@ -31,6 +34,8 @@ def pixelate(jet, charge_image = False, K = 0, K_two = 0, jet_center = [], img_s
     rap_i: the column index of the jet corresponding to rapidity
     phi_i: the column index of the jet corresponding to azimuthal angle
     pT_i: the column index of the jet corresponding to pT
+    dtype: the dtype of the returned image. The image is accumulated in 
+           float64 and converted at the end.
     """
 
     if nb_chan not in [1,2,3]:
@@ -41,7 +46,7 @@ def pixelate(jet, charge_image = False, K = 0, K_two = 0, jet_center = [], img_s
     jet_image = np.zeros((nb_chan, img_size, img_size))
 
     raps = jet[:,rap_i]
-    phis = jet[:,phi_i]
+    phis = np.copy(jet[:,phi_i])
     pts  = jet[:,pT_i]
 
     # deal with split images
@@ -73,6 +78,10 @@ def pixelate(jet, charge_image = False, K = 0, K_two = 0, jet_center = [], img_s
     rap_indices = rap_indices[mask].astype(int)
     phi_indices = phi_indices[mask].astype(int)
 
+    # look up the charges of all the particles at once
+    if nb_chan > 1:
+        charges = pdg_charges(jet[mask,3])
+
     # Without Jet Charge
     if charge_image == False:
         # construct grayscale image
@@ -83,18 +92,18 @@ def pixelate(jet, charge_image = False, K = 0, K_two = 0, jet_center = [], img_s
 
         # construct two-channel image
         elif nb_chan == 2:
-            for ph,y,pt,label in zip(phi_indices, rap_indices, 
-                                     pts[mask], jet[mask,3]):
+            for ph,y,pt,charge in zip(phi_indices, rap_indices, 
+                                      pts[mask], charges):
                 jet_image[0, ph, y] += pt
-                if charge_map[label] != 0:
+                if charge != 0:
                     jet_image[1, ph, y] += 1
             num_pt_chans = 1
 
         # construct three-channel image
         elif nb_chan == 3:
-            for ph,y,pt,label in zip(phi_indices, rap_indices, 
-                                     pts[mask], jet[mask,3].astype(int)):
-                if charge_map[label] == 0:
+            for ph,y,pt,charge in zip(phi_indices, rap_indices, 
+                                      pts[mask], charges):
+                if charge == 0:
                     jet_image[1, ph, y] += pt
                 else:
                     jet_image[0, ph, y] += pt
@@ -104,18 +113,18 @@ def pixelate(jet, charge_image = False, K = 0, K_two = 0, jet_center = [], img_s
     if charge_image == True:
         if nb_chan == 2:
             jet_pt = np.sum(pts)
-            for ph,y,pt,label in zip(phi_indices, rap_indices, 
-                                     pts[mask], jet[mask,3].astype(int)):
+            for ph,y,pt,charge in zip(phi_indices, rap_indices, 
+                                      pts[mask], charges):
                 jet_image[0, ph, y] += pt
-                jet_image[1, ph, y] += (charge_map[label] * pow(pt, K))/(pow(jet_pt,K))
+                jet_image[1, ph, y] += (charge * pow(pt, K))/(pow(jet_pt,K))
             num_pt_chans = 1
         if nb_chan == 3:
             jet_pt = np.sum(pts)
-            for ph,y,pt,label in zip(phi_indices, rap_indices,
-                                     pts[mask], jet[mask,3].astype(int)):
+            for ph,y,pt,charge in zip(phi_indices, rap_indices,
+                                      pts[mask], charges):
                 jet_image[0, ph, y] += pt
-                jet_image[1, ph, y] += (charge_map[label] * pow(pt, K))/(pow(jet_pt,K))
-                jet_image[2, ph, y] += (charge_map[label] * pow(pt, K_two))/(pow(jet_pt,K_two))
+                jet_image[1, ph, y] += (charge * pow(pt, K))/(pow(jet_pt,K))
+                jet_image[2, ph, y] += (charge * pow(pt, K_two))/(pow(jet_pt,K_two))
             num_pt_chans = 1            
         if nb_chan == 1:
             raise ValueError('Invalid number of channels for charged jet image, not implemented yet.')
@@ -129,11 +138,565 @@ def pixelate(jet, charge_image = False, K = 0, K_two = 0, jet_center = [], img_s
         else:
             jet_image[:num_pt_chans] = jet_image[:num_pt_chans]/normfactor
 
+    jet_image = jet_image.astype(dtype, copy = False)
     if len(jet_center) == 0 and centers:
         return jet_image, (rap_avg, phi_avg)
     else:
         return jet_image
 
+
+def _bin_particles(jets, jet_centers, img_size, img_width, rap_i, phi_i, pT_i):
+
+    """ Computes the pixel of every particle of a JetCollection exactly as in
+    pixelate, but for all of the jets at once.
+
+    Returns (jet_ids, pixels, pts, pdgids, jet_pts, centers) where the first
+    four are per-particle arrays restricted to the particles falling inside
+    their image, pixels being the flattened (phi, rap) pixel index, jet_pts
+    is the total pt of each jet including particles outside the image and 
+    centers is the (rap, phi) center of each jet.
+    """
+
+    if np.any(jets.counts == 0):
+        raise ValueError('Cannot pixelate a jet with no particles.')
+    starts = jets.offsets[:-1]
+    jet_ids = jets.jet_ids
+
+    pix_width = img_width / img_size
+    raps = jets.particles[:,rap_i]
+    phis = np.array(jets.particles[:,phi_i])
+    pts  = jets.particles[:,pT_i]
+
+    # deal with split images, the reference phi is that of the hardest particle
+    if len(jet_centers) == 0:
+        is_max = pts == np.maximum.reduceat(pts, starts)[jet_ids]
+        hardest = np.minimum.reduceat(np.where(is_max, np.arange(len(pts)), 
+                                               len(pts)), starts)
+        ref_phis = phis[hardest]
+    else:
+        jet_centers = np.asarray(jet_centers, dtype = float)
+        ref_phis = jet_centers[:,1]
+    ref_phis = ref_phis[jet_ids]
+    phis[phis - ref_phis >  img_width] -= 2 * np.pi
+    phis[phis - ref_phis < -img_width] += 2 * np.pi
+
+    # get jet pt centroids
+    jet_pts = np.bincount(jet_ids, weights = pts, minlength = len(jets))
+    if len(jet_centers) == 0:
+        rap_avgs = np.bincount(jet_ids, weights = raps * pts, 
+                               minlength = len(jets)) / jet_pts
+        phi_avgs = np.bincount(jet_ids, weights = phis * pts, 
+                               minlength = len(jets)) / jet_pts
+    else:
+        rap_avgs, phi_avgs = jet_centers[:,0], jet_centers[:,1]
+
+    rap_pt_cent_indices = np.ceil(rap_avgs/pix_width - .5) - np.floor(img_size / 2)
+    phi_pt_cent_indices = np.ceil(phi_avgs/pix_width - .5) - np.floor(img_size / 2)
+
+    # center images and transition to indices
+    rap_indices = np.ceil(raps/pix_width - .5) - rap_pt_cent_indices[jet_ids]
+    phi_indices = np.ceil(phis/pix_width - .5) - phi_pt_cent_indices[jet_ids]
+
+    # delete elements outside of range
+    mask = (rap_indices >= 0) & (phi_indices >= 0) & \
+           (rap_indices < img_size) & (phi_indices < img_size)
+    pixels = phi_indices[mask].astype(int) * img_size + rap_indices[mask].astype(int)
+
+    return jet_ids[mask], pixels, pts[mask], jets.particles[mask,3], jet_pts, \
+           np.stack((rap_avgs, phi_avgs), axis = 1)
+
+
+def _deposits(jet_ids, pixels, pts, pdgids, jet_pts, charge_image, K, K_two, 
+              nb_chan):
+
+    """ Returns (jet_ids, channels, pixels, weights, num_pt_chans) describing
+    what each particle adds to the channels of its image, following pixelate.
+    The returned arrays hold one entry per (particle, channel) deposit. 
+    Neutral particles add nothing to the charge count and jet charge 
+    channels, so they have no deposits there. """
+
+    if charge_image == True and nb_chan == 1:
+        raise ValueError('Invalid number of channels for charged jet image, not implemented yet.')
+
+    # (channel, weight) of every particle for the pt channels, and of the
+    # charged particles only for the other channels
+    if nb_chan > 1:
+        charges = pdg_charges(pdgids)
+        charged = np.flatnonzero(charges != 0)
+    if charge_image == False:
+        if nb_chan == 1:
+            all_deps, charged_deps, num_pt_chans = [(0, pts)], [], 1
+        elif nb_chan == 2:
+            all_deps, charged_deps, num_pt_chans = [(0, pts)], [(1, 1.)], 1
+        elif nb_chan == 3:
+            all_deps = [(np.where(charges != 0, 0, 1), pts)]
+            charged_deps, num_pt_chans = [(2, 1.)], 2
+    else:
+        charged_pts, charged_jet_pts = pts[charged], jet_pts[jet_ids[charged]]
+        all_deps, num_pt_chans = [(0, pts)], 1
+        charged_deps = [(1, charges[charged] * pow(charged_pts, K) / pow(charged_jet_pts, K))]
+        if nb_chan == 3:
+            charged_deps.append((2, charges[charged] * pow(charged_pts, K_two) / 
+                                    pow(charged_jet_pts, K_two)))
+
+    deposits = [(np.arange(len(pts)), chan, weight) for chan, weight in all_deps] + \
+               [(charged, chan, weight) for chan, weight in charged_deps]
+    return np.concatenate([jet_ids[rows] for rows, _, _ in deposits]), \
+           np.concatenate([np.broadcast_to(chan, rows.shape) for rows, chan, _ in deposits]), \
+           np.concatenate([pixels[rows] for rows, _, _ in deposits]), \
+           np.concatenate([np.broadcast_to(weight, rows.shape) for rows, _, weight in deposits]), \
+           num_pt_chans
+
+
+def _kappa_deposits(jet_ids, pixels, pts, pdgids, jet_pts, kappas, norm,
+                    nb_jets, nb_pix):
+
+    """ Returns (indices, weights) of the pt channel and of one jet charge
+    channel per kappa of the binned particles, the indices being flat indices
+    into an (nb_jets, 1 + len(kappas), img_size, img_size) array of images. 
+    The pixel indices and log(pt/jet_pt) are computed once and shared by all 
+    of the kappas, so each extra kappa only costs an exp over the charged 
+    particles. """
+
+    nb_chan = 1 + len(kappas)
+    indices = jet_ids * nb_chan * nb_pix + pixels
+
+    # the pt channel
+    weights = pts
+    if norm:
+        normfactors = np.bincount(jet_ids, weights = pts, minlength = nb_jets)
+        if np.any(normfactors == 0):
+            raise FloatingPointError('Image had no particles!')
+        weights = pts / normfactors[jet_ids]
+    all_indices, all_weights = [indices], [weights]
+
+    # the charge channels, neutral particles don't contribute to them
+    charges = pdg_charges(pdgids)
+    charged = charges != 0
+    charges, indices = charges[charged], indices[charged]
+    log_pt_fracs = np.log(pts[charged] / jet_pts[jet_ids[charged]])
+    for i, kappa in enumerate(kappas):
+        all_indices.append(indices + (i + 1) * nb_pix)
+        all_weights.append(charges * np.exp(kappa * log_pt_fracs))
+
+    return np.concatenate(all_indices), np.concatenate(all_weights)
+
+
+def _chunk_deposits(chunk, chunk_centers, charge_image, K, K_two, img_size, 
+                    img_width, nb_chan, norm, rap_i, phi_i, pT_i, kappas):
+
+    """ Returns (indices, weights, centers) for a JetCollection chunk, where
+    the images of the chunk are the sum of weights at the flat indices into 
+    an (nb_jets, nb_chan, img_size, img_size) array. An index can occur more
+    than once. """
+
+    nb_pix = img_size * img_size
+    jet_ids, pixels, pts, pdgids, jet_pts, chunk_centers = \
+        _bin_particles(chunk, chunk_centers, img_size, img_width, rap_i, phi_i, pT_i)
+    if len(kappas) > 0:
+        return _kappa_deposits(jet_ids, pixels, pts, pdgids, jet_pts, kappas, 
+                               norm, len(chunk), nb_pix) + (chunk_centers,)
+
+    jet_ids, chans, pixels, weights, num_pt_chans = \
+        _deposits(jet_ids, pixels, pts, pdgids, jet_pts, charge_image, K, 
+                  K_two, nb_chan)
+
+    # L1-normalize the pt channels of the jet images, which we can do
+    # on the deposits before they are added up
+    if norm:
+        is_pt = chans < num_pt_chans
+        normfactors = np.bincount(jet_ids[is_pt], weights = weights[is_pt],
+                                  minlength = len(chunk))
+        if np.any(normfactors == 0):
+            raise FloatingPointError('Image had no particles!')
+        weights = np.where(is_pt, weights / normfactors[jet_ids], weights)
+
+    return (jet_ids * nb_chan + chans) * nb_pix + pixels, weights, chunk_centers
+
+
+def pixelate_batch(jets, charge_image = False, K = 0, K_two = 0, jet_centers = [], img_size = 33, img_width = 0.8, nb_chan = 1, norm = True, 
+                   rap_i=0, phi_i=1, pT_i=2, centers = False, chunk_size = 10000,
+                   kappas = [], out = None, dtype = np.float32):
+
+    """ A vectorized version of pixelate which creates the images of a whole
+    collection of jets at once. Centering, phi wrap-around and binning are
+    done for all of the particles together and the channels are filled with
+    a single scatter-add per chunk of jets, so the result matches calling
+    pixelate on each jet up to floating point rounding.
+
+    jets: a JetCollection, or a list of per-jet arrays as taken by pixelate.
+    jet_centers: an (nb_jets, 2) array of the (y, phi) centers of the jets. If
+                 empty, compute the centers via the pt weighted centroids.
+    chunk_size: the number of jets processed at a time, which bounds the size
+                of the temporary arrays.
+    centers: if True and jet_centers is empty, also return the computed 
+             (nb_jets, 2) array of centers.
+    kappas: a list of jet charge exponents. If given, charge_image, K, K_two
+            and nb_chan are ignored and the images have 1 + len(kappas) 
+            channels, the pt channel followed by one charge channel per 
+            kappa, as made by pixelate with charge_image = True and K = kappa.
+            The particles are binned only once for all of the kappas.
+    out: if given, an array of shape (nb_jets, nb_chan, img_size, img_size)
+         that the images are written into instead of a newly allocated one,
+         e.g. a slice of a shared or memory-mapped array.
+    dtype: the dtype of the images if out is not given. The deposits are
+           computed in float64 and only summed up in dtype.
+
+    The remaining arguments are the same as for pixelate. Returns an array of
+    shape (nb_jets, nb_chan, img_size, img_size).
+    """
+
+    if len(kappas) > 0:
+        nb_chan = 1 + len(kappas)
+    elif nb_chan not in [1,2,3]:
+        raise ValueError('Invalid number of channels for jet image.')
+    if not isinstance(jets, JetCollection):
+        jets = jets_from_list(jets)
+
+    shape = (len(jets), nb_chan, img_size, img_size)
+    if out is None:
+        jet_images = np.zeros(shape, dtype = dtype)
+    else:
+        if out.shape != shape:
+            raise ValueError('out has shape {}, expected {}'.format(out.shape, shape))
+        if not out.flags.c_contiguous:
+            raise ValueError('out must be C-contiguous')
+        jet_images = out
+        jet_images[...] = 0
+    all_centers = np.zeros((len(jets), 2))
+
+    for start in range(0, len(jets), chunk_size):
+        chunk = jets[start:start+chunk_size]
+        chunk_centers = jet_centers[start:start+chunk_size] \
+                        if len(jet_centers) > 0 else []
+
+        # scatter-add all of the deposits of the chunk directly into its images
+        indices, weights, all_centers[start:start+len(chunk)] = \
+            _chunk_deposits(chunk, chunk_centers, charge_image, K, K_two, 
+                            img_size, img_width, nb_chan, norm, rap_i, phi_i, 
+                            pT_i, kappas)
+        np.add.at(jet_images[start:start+len(chunk)].reshape(-1), indices, 
+                  weights.astype(jet_images.dtype, copy = False))
+
+    if len(jet_centers) == 0 and centers:
+        return jet_images, all_centers
+    else:
+        return jet_images
+
+
+# state handed to the workers of pixelate_parallel when the pool is started
+_pixelate_state = {}
+
+
+def _init_pixelate_worker(jets, target, shape, dtype, kwargs):
+
+    """ Sets up a worker of pixelate_parallel with a view of the output. The
+    target is either the anonymous shared mapping itself, inherited through
+    fork, or the name of a .npy file which is memory-mapped for writing. """
+
+    if isinstance(target, str):
+        images = np.load(target, mmap_mode = 'r+')
+    else:
+        images = np.frombuffer(target, dtype = dtype).reshape(shape)
+    _pixelate_state.update(jets = jets, images = images, kwargs = kwargs)
+
+
+def _pixelate_range(bounds):
+
+    """ Pixelates the jets start:stop straight into their slice of the
+    shared output, nothing but the bounds goes through the pipe. """
+
+    start, stop = bounds
+    images = _pixelate_state['images']
+    pixelate_batch(_pixelate_state['jets'][start:stop], out = images[start:stop],
+                   **_pixelate_state['kwargs'])
+    if isinstance(images, np.memmap):
+        images.flush()
+    return stop - start
+
+
+def pixelate_parallel(jets, n_workers = None, filename = '', task_size = 5000,
+                      **kwargs):
+
+    """ Creates the images of a whole collection of jets with pixelate_batch
+    in a pool of worker processes. The output is allocated once, either in
+    shared memory or as a memory-mapped .npy file, and each worker writes
+    the images of its range of jets directly into it, so there is no final
+    concatenation and no images are sent between processes.
+
+    jets: a JetCollection, or a list of per-jet arrays as taken by pixelate.
+    n_workers: the number of worker processes. Defaults to the number of
+               cores, 1 creates the images serially in this process.
+    filename: if given, the images are written to this .npy file and a
+              memory map of it is returned. Otherwise the images are kept in 
+              anonymous shared memory, which requires the fork start method
+              (without it the images are created serially).
+    task_size: the number of jets handed to a worker at a time.
+    kwargs: passed on to pixelate_batch, except for centers and out.
+
+    Returns an array of shape (nb_jets, nb_chan, img_size, img_size).
+    """
+
+    if 'centers' in kwargs or 'out' in kwargs:
+        raise ValueError('centers and out are not supported by pixelate_parallel')
+    if not isinstance(jets, JetCollection):
+        jets = jets_from_list(jets)
+
+    kappas = kwargs.get('kappas', [])
+    nb_chan = 1 + len(kappas) if len(kappas) > 0 else kwargs.get('nb_chan', 1)
+    img_size = kwargs.get('img_size', 33)
+    shape = (len(jets), nb_chan, img_size, img_size)
+    dtype = np.dtype(kwargs.get('dtype', np.float32))
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = max(min(n_workers, -(-len(jets) // task_size)), 1)
+    can_fork = 'fork' in multiprocessing.get_all_start_methods()
+
+    if len(filename) > 0:
+        images = np.lib.format.open_memmap(filename, mode = 'w+', dtype = dtype,
+                                           shape = shape)
+        target = filename
+    elif n_workers > 1 and can_fork:
+        target = mmap.mmap(-1, max(int(np.prod(shape)) * dtype.itemsize, 1))
+        images = np.frombuffer(target, dtype = dtype, 
+                               count = int(np.prod(shape))).reshape(shape)
+    else:
+        n_workers = 1
+
+    if n_workers == 1:
+        if len(filename) == 0:
+            return pixelate_batch(jets, **kwargs)
+        pixelate_batch(jets, out = images, **kwargs)
+        images.flush()
+        return images
+
+    # with fork the workers inherit jets and the shared mapping rather than
+    # receiving pickled copies
+    context = multiprocessing.get_context('fork' if can_fork else None)
+    bounds = [(start, min(start + task_size, len(jets)))
+              for start in range(0, len(jets), task_size)]
+    with context.Pool(n_workers, initializer = _init_pixelate_worker,
+                      initargs = (jets, target, shape, dtype, kwargs)) as pool:
+        for _ in pool.imap_unordered(_pixelate_range, bounds):
+            pass
+
+    return images
+
+
+class SparseImages(object):
+
+    """ A collection of jet images storing only their nonzero pixels, in a
+    CSR-like layout by image. A jet image usually has a few dozen nonzero
+    pixels out of nb_chan * img_size**2, so this is many times smaller than
+    the dense array.
+
+    indices: the flat (channel, phi, rap) index, i.e. 
+             channel * img_size**2 + phi * img_size + rap, of every stored
+             pixel, sorted within each image.
+    values: the values of the stored pixels.
+    offsets: an array of length nb_images + 1 with offsets[0] = 0, such that
+             the pixels of image i are indices[offsets[i]:offsets[i+1]].
+    image_shape: the shape (nb_chan, img_size, img_size) of a single image.
+    """
+
+    def __init__(self, indices, values, offsets, image_shape):
+
+        self.indices = indices
+        self.values = values
+        self.offsets = np.asarray(offsets, dtype = np.int64)
+        self.image_shape = tuple(int(n) for n in image_shape)
+
+        if len(self.offsets) == 0 or self.offsets[0] != 0 or \
+           self.offsets[-1] != len(indices) or len(indices) != len(values):
+            raise ValueError('Offsets do not match the stored pixels')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, key):
+
+        """ An integer returns that image as a dense array, anything else 
+        selecting images (a slice, an array of indices or a boolean mask) 
+        returns a SparseImages holding them. """
+
+        if isinstance(key, (int, np.integer)):
+            return self.densify([key])[0]
+
+        rows = np.arange(len(self))[key]
+        counts = self.counts[rows]
+        offsets = np.zeros(len(rows) + 1, dtype = np.int64)
+        np.cumsum(counts, out = offsets[1:])
+        positions = self._positions(rows, counts, offsets[-1])
+        return SparseImages(self.indices[positions], self.values[positions],
+                            offsets, self.image_shape)
+
+    def __repr__(self):
+        return 'SparseImages({} images of shape {}, {} stored pixels)'.format(
+                len(self), self.image_shape, self.nnz)
+
+    @property
+    def shape(self):
+
+        """ The shape of the equivalent dense array. """
+
+        return (len(self),) + self.image_shape
+
+    @property
+    def nnz(self):
+        return len(self.values)
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.values.nbytes + self.offsets.nbytes
+
+    @property
+    def counts(self):
+
+        """ The number of stored pixels of each image. """
+
+        return np.diff(self.offsets)
+
+    def _positions(self, rows, counts, total):
+
+        """ The positions in indices and values of the pixels of rows. """
+
+        starts = np.zeros(len(rows), dtype = np.int64)
+        np.cumsum(counts[:-1], out = starts[1:])
+        return np.repeat(self.offsets[rows] - starts, counts) + np.arange(total)
+
+    def densify(self, rows, out = None):
+
+        """ Returns the dense images of rows, e.g. the indices of a minibatch.
+
+        rows: an array of image indices.
+        out: if given, an array of shape (len(rows), nb_chan, img_size, 
+             img_size) that is overwritten with the images, which lets the 
+             same buffer be reused for every batch.
+        """
+
+        rows = np.asarray(rows, dtype = np.int64).reshape(-1)
+        shape = (len(rows),) + self.image_shape
+        if out is None:
+            out = np.zeros(shape, dtype = self.values.dtype)
+        else:
+            if out.shape != shape:
+                raise ValueError('out has shape {}, expected {}'.format(out.shape, shape))
+            out[...] = 0
+
+        counts = self.counts[rows]
+        positions = self._positions(rows, counts, np.sum(counts))
+        img_len = int(np.prod(self.image_shape))
+        out.reshape(len(rows), img_len)[np.repeat(np.arange(len(rows)), counts),
+                                        self.indices[positions]] = self.values[positions]
+        return out
+
+    def to_dense(self):
+
+        """ Returns all of the images as a dense array. """
+
+        return self.densify(np.arange(len(self)))
+
+    def iter_batches(self, batch_size, rows = None):
+
+        """ Yields the dense images of consecutive batches of rows (all of 
+        the images in order if None), filled into a single reused buffer. 
+        Copy a batch if it has to outlive the next iteration. """
+
+        rows = np.arange(len(self)) if rows is None else np.asarray(rows)
+        buffer = np.zeros((batch_size,) + self.image_shape, dtype = self.values.dtype)
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start+batch_size]
+            yield self.densify(batch, out = buffer[:len(batch)])
+
+
+def sparse_images_from_deposits(indices, weights, nb_images, image_shape):
+
+    """ Builds a SparseImages from flat indices into an (nb_images,) + 
+    image_shape array and the weights to be added there. Repeated indices 
+    are summed, and pixels that end up zero (e.g. opposite charges 
+    cancelling) are not stored. """
+
+    img_len = int(np.prod(image_shape))
+    nonzero = weights != 0
+    keys, inverse = np.unique(indices[nonzero], return_inverse = True)
+    values = np.bincount(inverse.reshape(-1), weights = weights[nonzero], 
+                         minlength = len(keys))
+    nonzero = values != 0
+    keys, values = keys[nonzero], values[nonzero]
+    offsets = np.zeros(nb_images + 1, dtype = np.int64)
+    np.cumsum(np.bincount(keys // img_len, minlength = nb_images), out = offsets[1:])
+    pixel_dtype = np.uint16 if img_len <= np.iinfo(np.uint16).max + 1 else np.int32
+    return SparseImages((keys % img_len).astype(pixel_dtype), values, offsets, 
+                        image_shape)
+
+
+def sparse_images_from_dense(images):
+
+    """ Builds a SparseImages holding the nonzero pixels of a dense 
+    (nb_images, nb_chan, img_size, img_size) array. """
+
+    flat = np.reshape(images, (len(images), -1))
+    nonzero = np.flatnonzero(flat)
+    return sparse_images_from_deposits(nonzero, flat.reshape(-1)[nonzero], 
+                                       len(images), images.shape[1:])
+
+
+def concatenate_sparse_images(collections):
+
+    """ Concatenates a sequence of SparseImages with the same image shape. """
+
+    collections = list(collections)
+    if any(c.image_shape != collections[0].image_shape for c in collections):
+        raise ValueError('Cannot concatenate images of different shapes')
+    offsets = [np.zeros(1, dtype = np.int64)]
+    nnz = 0
+    for c in collections:
+        offsets.append(c.offsets[1:] + nnz)
+        nnz += c.nnz
+    return SparseImages(np.concatenate([c.indices for c in collections]),
+                        np.concatenate([c.values for c in collections]),
+                        np.concatenate(offsets), collections[0].image_shape)
+
+
+def pixelate_sparse(jets, jet_centers = [], img_size = 33, nb_chan = 1, 
+                    chunk_size = 10000, kappas = [], dtype = np.float32, **kwargs):
+
+    """ Creates the images of a collection of jets directly in sparse form,
+    never allocating the dense images. The arguments are the same as for 
+    pixelate_batch, except that centers and out are not supported. Returns
+    a SparseImages with the same content as the pixelate_batch images, its
+    values being of type dtype. """
+
+    if len(kappas) > 0:
+        nb_chan = 1 + len(kappas)
+    elif nb_chan not in [1,2,3]:
+        raise ValueError('Invalid number of channels for jet image.')
+    if not isinstance(jets, JetCollection):
+        jets = jets_from_list(jets)
+    kwargs = dict(dict(charge_image = False, K = 0, K_two = 0, img_width = 0.8,
+                       norm = True, rap_i = 0, phi_i = 1, pT_i = 2), **kwargs)
+
+    image_shape = (nb_chan, img_size, img_size)
+    chunks = []
+    for start in range(0, len(jets), chunk_size):
+        chunk = jets[start:start+chunk_size]
+        chunk_centers = jet_centers[start:start+chunk_size] \
+                        if len(jet_centers) > 0 else []
+        indices, weights, _ = _chunk_deposits(chunk, chunk_centers, 
+                                              img_size = img_size, nb_chan = nb_chan,
+                                              kappas = kappas, **kwargs)
+        chunk_images = sparse_images_from_deposits(indices, weights, len(chunk),
+                                                   image_shape)
+        chunk_images.values = chunk_images.values.astype(dtype)
+        chunks.append(chunk_images)
+
+    if len(chunks) == 0:
+        return SparseImages(np.zeros(0, dtype = np.uint16), np.zeros(0, dtype = dtype),
+                            np.zeros(1, dtype = np.int64), image_shape)
+    return concatenate_sparse_images(chunks)
+
+
 def upsample(images, factor = 1):
 
     """ A function for upsampling (A,B,N,N) images to (A,B, factor*N, factor*N) images, preserving norm
@@ -155,7 +718,8 @@ def downsample(images, factor = 1):
 
 
 def write_images_to_file(base_name, images, path = '../images', 
-                         addendum = '_{0}x{0}images_{1}chan'):
+                         addendum = '_{0}x{0}images_{1}chan', store = False,
+                         params = {}, dtype = None):
 
     """ A function used for writing images to file as a numpy compressed
     array. Assumes that images has shape (nb_images, nb_chan, img_size, 
@@ -168,45 +732,403 @@ def write_images_to_file(base_name, images, path = '../images',
     addendum: standard string to append to end of the base name. the default
               will include information about the size of the images and the
               number of channels they have.
+    store: if True, write an uncompressed image store (see write_image_store)
+           instead of a .npz file, which can be memory-mapped when loaded.
+    params: the generation parameters recorded in the header of a store.
+    dtype: the dtype the images are stored as, e.g. np.float16 to halve the
+           size on disk. Defaults to the dtype of images. load_images 
+           converts them back to its dtype.
     """
 
     ts = clock()
     fprint('Writing images for {} to file ... '.format(base_name))
-    filename = os.path.join(path, (base_name + addendum).format(
-                                    len(images[0][0]), len(images[0])))
-    np.savez_compressed(filename, images)
+    filename = (base_name + addendum).format(len(images[0][0]), len(images[0]))
+    if store:
+        write_image_store(filename, images, path = path, params = params, 
+                          dtype = dtype)
+    else:
+        np.savez_compressed(os.path.join(path, filename), 
+                            images if dtype is None else np.asarray(images, dtype = dtype))
     fprint('Done, in {:.3f} seconds.\n'.format(clock() - ts))
 
 
+# bump whenever the layout of image stores changes
+IMAGE_STORE_VERSION = 1
+
+
+def _image_store_files(name, path):
+
+    """ Returns the names of the array file and of the header of a store. """
+
+    base = os.path.join(path, name)
+    return base + '.npy', base + '.json'
+
+
+def _image_source_info(filename):
+
+    """ The properties of an image file that a store built from it is keyed
+    on. """
+
+    stat = os.stat(filename)
+    return {'file': os.path.abspath(filename), 'size': stat.st_size, 
+            'mtime': stat.st_mtime_ns}
+
+
+def _create_image_store(name, shape, dtype, path):
+
+    """ Returns a writable memory map of a new store's array, which only
+    becomes visible under its final name with _finish_image_store. """
+
+    os.makedirs(path, exist_ok = True)
+    array_file = _image_store_files(name, path)[0]
+    return np.lib.format.open_memmap(temporary_name(array_file), mode = 'w+', 
+                                     dtype = dtype, shape = shape)
+
+
+def _finish_image_store(name, images, path, header):
+
+    """ Moves the array of a store created by _create_image_store into place
+    and then writes its header, so a store is only ever seen complete. """
+
+    array_file = _image_store_files(name, path)[0]
+    images.flush()
+    os.replace(images.filename, array_file)
+    _write_image_store_header(name, path, dict(header, shape = list(images.shape),
+                                               dtype = images.dtype.str))
+
+
+def _write_image_store_header(name, path, header):
+
+    """ Atomically replaces the JSON header of a store. """
+
+    header_file = _image_store_files(name, path)[1]
+    with atomic_write(header_file, 'w') as fh:
+        json.dump(dict(header, version = IMAGE_STORE_VERSION), fh)
+
+
+def write_image_store(name, images, path = '../images', boundaries = [], 
+                      params = {}, dtype = None):
+
+    """ Writes images to an uncompressed image store, consisting of the raw
+    array in name.npy and a small JSON header in name.json holding the shape,
+    dtype, class boundaries and generation parameters. Stores are loaded as
+    memory maps by load_image_store, so loading is nearly instant and the
+    processes of a node share the page cache.
+
+    name: the name of the store, without an extension.
+    images: the array of images.
+    path: the directory holding the store.
+    boundaries: the indices at which a new class begins, e.g. [nb_gluons].
+    params: a JSON serializable dict of the generation parameters.
+    dtype: the dtype the images are stored as. Defaults to the dtype of 
+           images.
+    """
+
+    if dtype is None:
+        dtype = np.asarray(images[:0]).dtype
+    out = _create_image_store(name, np.shape(images), dtype, path)
+    out[:] = images
+    _finish_image_store(name, out, path, {'boundaries': list(boundaries), 
+                                          'params': params, 'sources': []})
+
+
+def load_image_store(name, path = '../images'):
+
+    """ Returns (images, header) of an image store, images being a read-only
+    memory map. Raises an OSError if there is no complete store of that 
+    name. For a store that is being appended to, or whose writer was 
+    interrupted, the images up to the last checkpoint are returned. """
+
+    array_file, header_file = _image_store_files(name, path)
+    with open(header_file, 'r') as fh:
+        header = json.load(fh)
+    if header.get('version') != IMAGE_STORE_VERSION:
+        raise OSError('Image store {} has an unsupported version'.format(name))
+    images = np.load(array_file, mmap_mode = 'r')
+
+    # an appended batch is on disk before it is recorded in the header
+    nb_images = header['shape'][0]
+    if list(images.shape[1:]) != header['shape'][1:] or len(images) < nb_images:
+        raise OSError('Image store {} does not match its header'.format(name))
+    return images[:nb_images], header
+
+
+# the .npy header of an appendable store is padded to this length so that it
+# can be rewritten in place as the number of images grows
+APPENDABLE_NPY_HEADER_LEN = 128
+
+
+def _npy_header(shape, dtype):
+
+    """ The version 1.0 .npy header of an array, padded with spaces to 
+    APPENDABLE_NPY_HEADER_LEN bytes. """
+
+    descr = repr({'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                  'fortran_order': False, 'shape': tuple(shape)})
+    prefix = np.lib.format.magic(1, 0) + b'\x00\x00'
+    pad = APPENDABLE_NPY_HEADER_LEN - len(prefix) - len(descr) - 1
+    if pad < 0:
+        raise ValueError('Shape {} is too large for an appendable store'.format(shape))
+    header = (descr + ' ' * pad + '\n').encode('latin1')
+    return np.lib.format.magic(1, 0) + len(header).to_bytes(2, 'little') + header
+
+
+class ImageStoreWriter(object):
+
+    """ Writes an image store (see write_image_store) incrementally, so the
+    images never have to be held in memory all at once. 
+
+        writer = ImageStoreWriter(name, (nb_chan, img_size, img_size))
+        for batch in batches:
+            writer.append(batch)
+        writer.close()
+
+    Each append grows the array file in place and then records a checkpoint
+    in the header, so after an interrupted run the store can be loaded with
+    everything up to the last checkpoint. With resume = True, a writer opened
+    on such a store continues after the last checkpoint, count telling how
+    many images are already there.
+
+    name: the name of the store, without an extension.
+    image_shape: the shape of a single image.
+    path: the directory holding the store.
+    dtype: the dtype the images are stored as.
+    boundaries: the indices at which a new class begins, e.g. [nb_gluons].
+    params: a JSON serializable dict of the generation parameters.
+    resume: whether to continue an existing store rather than starting over.
+            A store is only continued if it has the same image shape, dtype,
+            boundaries and params, any other store of that name is replaced.
+    """
+
+    def __init__(self, name, image_shape, path = '../images', dtype = np.float32,
+                 boundaries = [], params = {}, resume = True):
+
+        self.name, self.path = name, path
+        self.image_shape = tuple(int(n) for n in image_shape)
+        self.dtype = np.dtype(dtype)
+        # as they will read back from the JSON header, for comparing with it
+        boundaries = [int(b) for b in boundaries]
+        params = json.loads(json.dumps(params))
+        self.header = {'boundaries': boundaries, 'params': params,
+                       'sources': [], 'checkpoints': [], 'complete': False}
+        self.count = 0
+
+        os.makedirs(path, exist_ok = True)
+        array_file = _image_store_files(name, path)[0]
+        if resume:
+            try:
+                images, header = load_image_store(name, path)
+                if tuple(images.shape[1:]) == self.image_shape and \
+                   images.dtype == self.dtype and 'checkpoints' in header and \
+                   header['boundaries'] == boundaries and header['params'] == params:
+                    self.header, self.count = header, len(images)
+                del images
+            except (OSError, ValueError, KeyError):
+                pass
+
+        # drop anything past the last checkpoint and continue from there
+        mode = 'r+b' if self.count > 0 else 'w+b'
+        self._fh = open(array_file, mode)
+        self._fh.truncate(APPENDABLE_NPY_HEADER_LEN + self.count * self._image_bytes)
+        self._checkpoint(complete = False)
+
+    @property
+    def _image_bytes(self):
+        return int(np.prod(self.image_shape)) * self.dtype.itemsize
+
+    def _checkpoint(self, complete):
+
+        """ Makes the images written so far durable, then records them in the
+        .npy header and finally in the JSON header. """
+
+        shape = (self.count,) + self.image_shape
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._fh.seek(0)
+        self._fh.write(_npy_header(shape, self.dtype))
+        self._fh.flush()
+        if len(self.header['checkpoints']) == 0 or \
+           self.header['checkpoints'][-1] != self.count:
+            self.header['checkpoints'].append(self.count)
+        self.header.update(shape = list(shape), dtype = self.dtype.str,
+                           complete = complete)
+        _write_image_store_header(self.name, self.path, self.header)
+
+    def append(self, images):
+
+        """ Appends a batch of images of shape (nb_images,) + image_shape and
+        checkpoints the store. """
+
+        images = np.ascontiguousarray(images, dtype = self.dtype)
+        if images.shape[1:] != self.image_shape:
+            raise ValueError('Images have shape {}, expected {}'.format(
+                             images.shape[1:], self.image_shape))
+        self._fh.seek(APPENDABLE_NPY_HEADER_LEN + self.count * self._image_bytes)
+        self._fh.write(images.data)
+        self.count += len(images)
+        self._checkpoint(complete = False)
+
+    def close(self):
+
+        """ Marks the store as complete and closes the file. """
+
+        if self._fh is not None:
+            self._checkpoint(complete = True)
+            self._fh.close()
+            self._fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+
+        # an exception leaves the store at its last checkpoint, not complete
+        if exc[0] is None:
+            self.close()
+        elif self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+
+def pixelate_to_store(name, jet_chunks, path = '../images', params = {}, 
+                      resume = True, n_workers = 1, **kwargs):
+
+    """ Streams jets into an image store in constant memory. Each chunk of
+    jets is pixelated with pixelate_batch and appended to the store, and if 
+    a previous run was interrupted the jets before its last checkpoint are 
+    skipped rather than pixelated again.
+
+    name: the name of the store, without an extension.
+    jet_chunks: an iterable of JetCollections, e.g. from iter_event_file.
+    path: the directory holding the store.
+    params: a JSON serializable dict of the generation parameters.
+    resume: whether to continue an interrupted store, see ImageStoreWriter.
+    n_workers: if not 1, each chunk is pixelated with pixelate_parallel using
+               this many worker processes (None for the number of cores).
+    kwargs: passed on to pixelate_batch, except for centers and out.
+
+    Returns the number of images in the store.
+    """
+
+    kappas = kwargs.get('kappas', [])
+    nb_chan = 1 + len(kappas) if len(kappas) > 0 else kwargs.get('nb_chan', 1)
+    img_size = kwargs.get('img_size', 33)
+
+    with ImageStoreWriter(name, (nb_chan, img_size, img_size), path = path,
+                          dtype = kwargs.get('dtype', np.float32), 
+                          params = params, resume = resume) as writer:
+        skip = writer.count
+        for jets in jet_chunks:
+            if skip >= len(jets):
+                skip -= len(jets)
+                continue
+            if n_workers == 1:
+                writer.append(pixelate_batch(jets[skip:], **kwargs))
+            else:
+                writer.append(pixelate_parallel(jets[skip:], n_workers = n_workers,
+                                                **kwargs))
+            skip = 0
+        count = writer.count
+    return count
+
+
+def _load_image_file(filename):
+
+    """ Loads the images of a single file, an image store (memory-mapped) or
+    a .npz file written by write_images_to_file. """
+
+    if filename.endswith('.npy'):
+        return np.load(filename, mmap_mode = 'r')
+    with np.load(filename) as data:
+        return data['arr_0']
+
+
 def load_images(gluon_img_files, quark_img_files, nb_gluons, nb_quarks, 
-                img_size = 33, nb_chan = 1, path = '../images'):
+                img_size = 33, nb_chan = 1, path = '../images', store_name = '',
+                params = {}, dtype = np.float32):
 
     """ A function for loading in images files and returning them in a single 
     numpy array.
 
-    gluon_img_files: a list of filenames containing the gluon images.
+    gluon_img_files: a list of filenames containing the gluon images, either
+                     .npz files or .npy image stores.
     quark_img_files: a list of filenames containing the quark images.
     nb_gluons: the total number of gluons.
     nb_quarks: the total number of quarks.
+    store_name: if given, the images are returned as a read-only memory map
+                of the image store of this name in path. The store is built
+                from the files the first time and rebuilt whenever the files
+                change, later calls only map it.
+    params: the generation parameters recorded in a newly built store.
+    dtype: the dtype of the returned images. Files stored with a different
+           dtype (e.g. float16) are converted as they are copied in.
     """
 
-    # allocate numpy array to hold all the jet images
-    images = np.zeros((nb_gluons + nb_quarks, nb_chan, img_size, img_size))
+    shape = (nb_gluons + nb_quarks, nb_chan, img_size, img_size)
+    dtype = np.dtype(dtype)
+    img_files = [os.path.join(path, f) 
+                 for f in parg(gluon_img_files) + parg(quark_img_files)]
+
+    if len(store_name) > 0:
+        sources = [_image_source_info(f) for f in img_files]
+        try:
+            images, header = load_image_store(store_name, path)
+            if header['sources'] == sources and images.shape == shape and \
+               images.dtype == dtype:
+                return images
+        except (OSError, ValueError, KeyError):
+            pass
+        # fill the store directly, without an intermediate array
+        images = _create_image_store(store_name, shape, dtype, path)
+    else:
+        # allocate numpy array to hold all the jet images
+        images = np.zeros(shape, dtype = dtype)
 
     index = 0
-    for gluon_file in parg(gluon_img_files):
-        local_images = np.load(os.path.join(path, gluon_file))['arr_0']
+    for img_file in img_files:
+        local_images = _load_image_file(img_file)
         images[index:index+local_images.shape[0]] = local_images
         index += local_images.shape[0]
 
-    for quark_file in parg(quark_img_files):
-        local_images = np.load(os.path.join(path, quark_file))['arr_0']
-        images[index:index+local_images.shape[0]] = local_images
-        index += local_images.shape[0]
+    if len(store_name) > 0:
+        _finish_image_store(store_name, images, path, 
+                            {'boundaries': [nb_gluons], 'params': params,
+                             'sources': sources})
+        return load_image_store(store_name, path)[0]
 
     return images
 
 
+def write_sparse_images_to_file(base_name, images, path = '../images',
+                                addendum = '_{0}x{0}images_{1}chan_sparse'):
+
+    """ Like write_images_to_file, but for a SparseImages, whose arrays are
+    saved to a single .npz file. """
+
+    ts = clock()
+    fprint('Writing sparse images for {} to file ... '.format(base_name))
+    filename = os.path.join(path, (base_name + addendum).format(
+                                    images.image_shape[1], images.image_shape[0]))
+    np.savez_compressed(filename, indices = images.indices, values = images.values,
+                        offsets = images.offsets, 
+                        image_shape = np.asarray(images.image_shape))
+    fprint('Done, in {:.3f} seconds.\n'.format(clock() - ts))
+
+
+def load_sparse_images(gluon_img_files, quark_img_files, path = '../images'):
+
+    """ Loads files written by write_sparse_images_to_file into a single 
+    SparseImages, gluons first and then quarks as in load_images. The images
+    stay sparse, use SparseImages.densify to get dense minibatches. """
+
+    collections = []
+    for img_file in parg(gluon_img_files) + parg(quark_img_files):
+        with np.load(os.path.join(path, img_file)) as data:
+            collections.append(SparseImages(data['indices'], data['values'], 
+                                            data['offsets'], data['image_shape']))
+    return concatenate_sparse_images(collections)
+
+
 def make_labels(nb_gluons, nb_quarks, one_hot = True):
 
     """ Constructs class labels for quarks and gluons. Labels gluons as
@@ -224,7 +1146,8 @@ def make_labels(nb_gluons, nb_quarks, one_hot = True):
         return labels
 
 
-def zero_center(*args, channels = [], copy = False):
+def zero_center(*args, channels = [], copy = False, dtype = np.float32,
+                chunk_size = 10000):
 
     """ Subtracts the mean of arg[0,channels] from the other arguments.
     Assumes that the arguments are numpy arrays. The expected use case would
@@ -234,6 +1157,13 @@ def zero_center(*args, channels = [], copy = False):
               channels being affected.
     copy: if True, the arguments are unaffected. if False, the arguments
           themselves may be modified
+    dtype: the dtype of the returned arrays. Arguments of another dtype are
+           converted, so only those already of type dtype are modified in 
+           place. The mean is accumulated in float64.
+    chunk_size: the number of images processed at a time. The mean is found
+                in one streaming pass (see compute_image_stats) and then 
+                subtracted chunk by chunk, so memory-mapped arguments are 
+                never loaded as a whole.
     """
 
     assert len(args) > 0
@@ -245,25 +1175,23 @@ def zero_center(*args, channels = [], copy = False):
         channels = parg(channels)
 
     # compute mean of the first argument
-    mean = np.mean(args[0], axis = 0)
+    mean = compute_image_stats(args[0], chunk_size).mean
 
     # copy arguments if requested
     if copy:
-        X = [np.copy(arg) for arg in args]
+        X = [np.array(arg, dtype = dtype) for arg in args]
     else:
-        X = args
+        X = [np.asarray(arg, dtype = dtype) for arg in args]
 
-    # iterate through arguments and channels
+    # subtract the mean chunk by chunk
     for x in X:
-        for chan in channels:
-
-            # use broadcasting to do the heavy lifting here
-            x[:,chan] -= mean[chan]
+        normalize_images(x, mean = mean, channels = channels, chunk_size = chunk_size)
 
     return X
 
 
-def standardize(*args, channels = [], copy = False, reg = 10**-6):
+def standardize(*args, channels = [], copy = False, reg = 10**-6, 
+                dtype = np.float32, chunk_size = 10000):
 
     """ Normalizes each argument by the standard deviation of the pixels in 
     arg[0]. The expected use case would be standardize(X_train, X_val, X_test).
@@ -273,6 +1201,9 @@ def standardize(*args, channels = [], copy = False, reg = 10**-6):
     copy: if True, the arguments are unaffected. if False, the arguments
           themselves may be modified
     reg: used to prevent divide by zero 
+    dtype: the dtype of the returned arrays, as for zero_center. The standard
+           deviation is accumulated in float64.
+    chunk_size: the number of images processed at a time, as for zero_center.
     """
 
     assert len(args) > 0
@@ -283,29 +1214,77 @@ def standardize(*args, channels = [], copy = False, reg = 10**-6):
     else:
         channels = parg(channels)
 
-    stds = np.std(args[0], axis = 0) + reg
+    stds = compute_image_stats(args[0], chunk_size).std + reg
 
     # copy arguments if requested
     if copy:
-        X = [np.copy(arg) for arg in args]
+        X = [np.array(arg, dtype = dtype) for arg in args]
     else:
-        X = args
+        X = [np.asarray(arg, dtype = dtype) for arg in args]
 
-    # iterate through arguments and channels
+    # divide by the standard deviations chunk by chunk
     for x in X:
-        for chan in channels:
-
-            # use broadcasting to do the heavy lifting here
-            x[:,chan] /= stds[chan]
+        normalize_images(x, std = stds, channels = channels, chunk_size = chunk_size)
 
     return X
 
 
-def apply_jitter(images, Y = [], which = 'all', step = 1, shuffle = True):
+def lazy_normalize(*args, channels = [], reg = 10**-6, dtype = np.float32,
+                   stats_file = '', key = {}, chunk_size = 10000):
+
+    """ The lazy equivalent of zero_center followed by standardize. Rather 
+    than modifying or copying the arguments, returns IndexedArray views of 
+    them whose batches are converted to dtype and normalized as they are 
+    gathered. The expected use case would be
+    lazy_normalize(X_train, X_val, X_test) on the lazy splits of data_split.
+
+    channels: which channels to normalize. The default will lead to all
+              channels being affected.
+    reg: used to prevent divide by zero.
+    stats_file: if given, the statistics of args[0] are saved to this file
+                and reused by later calls on the same rows, so only the
+                first call makes a pass over the training images.
+    key: a JSON serializable dict identifying the dataset, stored with the 
+         statistics. The rows of args[0] are added to it automatically, and
+         so are the path, size and modification time of the file if args[0]
+         is (a view of) a memory map, e.g. an image store, so statistics of
+         a store are recomputed when it is rebuilt.
+    """
+
+    assert len(args) > 0
+
+    views = [arg if isinstance(arg, IndexedArray) else 
+             IndexedArray(arg, np.arange(len(arg))) for arg in args]
+    key = dict(key, nb_rows = len(views[0]), 
+               rows_crc = zlib.crc32(np.ascontiguousarray(views[0].indices)))
+    if isinstance(views[0].base, np.memmap) and views[0].base.filename is not None:
+        key['source'] = _image_source_info(views[0].base.filename)
+
+    stats = ImageStats.load(stats_file, key) if len(stats_file) > 0 else None
+    if stats is None:
+        stats = compute_image_stats(views[0], chunk_size)
+        if len(stats_file) > 0:
+            try:
+                stats.save(stats_file, key)
+            except OSError:
+                pass
+
+    mean, std = stats.mean, stats.std + reg
+    def transform(batch):
+        return normalize_images(batch.astype(dtype, copy = False), mean = mean,
+                                std = std, channels = channels)
+
+    return [view.with_transform(transform) for view in views]
+
+
+def apply_jitter(images, Y = [], which = 'all', step = 1, shuffle = True, 
+                 dtype = np.float32):
 
     """ A function to apply various transformations to a set of images and
     return an expanded set of images containing the results of those operations,
-    including the identity operation.
+    including the identity operation. This holds n_jitter + 1 copies of the
+    images at once, JitterAugmenter produces the same images lazily per 
+    minibatch instead.
 
     Y: if present, an array that is assumed to pair with images (labels, etc.)
        and will be duplicated and returned along with the jittered images so
@@ -314,62 +1293,23 @@ def apply_jitter(images, Y = [], which = 'all', step = 1, shuffle = True):
            which type of operations are performed
     step: how many steps (measured by the manhattan metric) to translate by
     shuffle: whether or not to shuffle the results before returning
+    dtype: the dtype of the returned images
     """
 
-    # assure proper usage
-    assert which in ['all','reflect','translate'], 'Invalid jittering'
+    # the identity followed by the reflections and translations
+    transforms = jitter_transforms(which, step)
 
     # compute some sizes
     n_tot, n_chan = images.shape[0], images.shape[1]
     img_size = images.shape[2]
-    n_trans = 2 * step * (step + 1)
-    n_jitter = 3 if which == 'reflect' else \
-                    (n_trans if which == 'translate' else n_trans + 3)
+    n_jitter = len(transforms) - 1
 
     # allocate memory in advance, this saves max memory usage by a factor of 2
-    z = np.zeros((n_tot * (n_jitter + 1), n_chan, img_size, img_size))
-
-    # set beginning chunk of memory equal to X_train
-    z[:n_tot] = images
-
-    # use index to keep track of which memory block we're indexing into
-    index = n_tot
-    if which == 'all' or which == 'reflect':
-        z[n_tot:2*n_tot]   = images[:,:,::-1,:] # rap flip
-        z[2*n_tot:3*n_tot] = images[:,:,:,::-1] # phi flip
-        z[3*n_tot:4*n_tot] = images[:n_tot,:,::-1,::-1] # eta and phi flip
-        index = 4 * n_tot
-       # fprint('Jittered data by reflecting\n')
-
-    if which == 'all' or which == 'translate':
-        for i in range(-step, step + 1):
-            for j in range(-step, step + 1):
-                if 0 < abs(i) + abs(j) <= step:
-                    if i >= 0:
-                        start_ix = 0
-                        end_ix = img_size - i
-                        start_iz = i
-                        end_iz = img_size
-                    else:
-                        start_ix = abs(i)
-                        end_ix = img_size
-                        start_iz = 0
-                        end_iz = img_size - abs(i)
-                    if j >= 0:
-                        start_jx = 0
-                        end_jx = img_size - j
-                        start_jz = j
-                        end_jz = img_size
-                    else:
-                        start_jx = abs(j)
-                        end_jx = img_size
-                        start_jz = 0
-                        end_jz = img_size - abs(j)
-                    z[index:index+n_tot,:,start_iz:end_iz,start_jz:end_jz] = \
-                               images[:,:,start_ix:end_ix,start_jx:end_jx]
-                    index += n_tot
-                    #fprint('Jittered data by translating rap {}, phi {}\n'
-                    #       .format(i,j))
+    z = np.zeros((n_tot * (n_jitter + 1), n_chan, img_size, img_size), dtype = dtype)
+
+    # fill one block of memory per transform
+    for index, transform in enumerate(transforms):
+        transform_images(images, transform, out = z[index*n_tot:(index+1)*n_tot])
 
     p = np.random.permutation(z.shape[0]) if shuffle \
                                                      else np.arange(z.shape[0])
@@ -3,53 +3,118 @@
 # Computes Jet Charge
 
 import numpy as np
-from data_import_modified import data_import
+import multiprocessing
+import os
+import pickle
+from data_import_modified import event_file_name
 import matplotlib.pyplot as plt
+from .ROC_tools import batch_ROC
+from .jet_collection import JetCollection, concatenate_jets, jets_from_list
+from .event_io import load_event_files
+from .charges import charge_map, pdg_charges
 
-# mapping from particle id to charge of the particle
-charge_map = {11: -1, -11:  1, 13: -1, -13:  1, 22:  0, -22:  0,
-              111:  0, -111:  0, 130:  0, -130:  0, 211:  1, -211: -1,
-              321:  1, -321: -1, 2112:  0, -2112:  0, 2212:  1, -2212: -1}
 
-def get_jets(hps):
+def _event_file_names(hps, particle_type):
 
-    """Loops through files to create an array of jets"""
-    index = 0
+    """The names of the seed files of particle_type"""
+    return [event_file_name(seed_number, particle_type, prefix = hps["energy"])
+            for seed_number in range(1, 1 + hps["n_files"])]
+
+def get_jets(hps, n_workers = None):
+
+    """Creates a JetCollection of the jets of all particle1 seed files 
+    followed by all particle2 seed files. The files are loaded in parallel
+    by n_workers processes, defaulting to one per core"""
+    filenames = []
     # Loop through quark and gluon events
     for particle_type in [hps["particle1_type"], hps["particle2_type"]]:
-        # Loop through seed number
-        for seed_number in range(1,1 + hps["n_files"]):
-            # import the jets
-            jets, jet_tots = data_import('event', range(1,1 + hps["n_files"]), 
-                             seed_number, particle_type, prefix = hps["energy"])
-            if index == 0:
-                all_jets = jets
-                all_jet_tots = jet_tots
-            else:
-                all_jets = np.append(all_jets, jets)
-                all_jet_tots = np.append(all_jet_tots, jet_tots)
-            index += 1
-
-    return all_jets, all_jet_tots
+        filenames += _event_file_names(hps, particle_type)
+
+    all_jets = load_event_files(filenames, n_workers = n_workers)
+    return all_jets, all_jets.jet_tots
 
 def jet_charges(hps, jets, n_ev_perf=10000, BDT = False, kappa = 0):
 
-    """Returns an array of jet charges"""
+    """Returns an array of jet charges. jets can either be a collection of
+    jets or an iterable of JetCollection chunks (e.g. from 
+    heppy.iter_event_file), in which case the jets are streamed chunk by 
+    chunk"""
     if BDT == True:
         hps['kappa'] = kappa
 
     #allocate array
     n_files = hps['n_files']
     jet_charges = np.zeros(2 * n_files * n_ev_perf)
-    index = 0
 
     # fill array of jet charges
-    for jet in jets:
-            jet_charges[index] = compute_jet_charge(jet, hps)
-            index += 1
+    charges = compute_jet_charges(jets, [hps['kappa']])[:,0]
+    jet_charges[:len(charges)] = charges
 
     return jet_charges
 
+def _jet_chunks(jets, chunk_size):
+
+    """Yields JetCollections of at most chunk_size jets from a JetCollection,
+    a list of per-jet arrays or an iterable of JetCollection chunks"""
+    if isinstance(jets, list) and not any(isinstance(item, JetCollection) 
+                                          for item in jets):
+        jets = jets_from_list(jets)
+    if isinstance(jets, JetCollection):
+        jets = [jets]
+    for chunk in jets:
+        if not isinstance(chunk, JetCollection):
+            chunk = jets_from_list([chunk])
+        for start in range(0, len(chunk), chunk_size):
+            yield chunk[start:start+chunk_size]
+
+def compute_jet_charges(jets, kappas, chunk_size = 500, pT_i = 2, id_i = 3):
+
+    """Returns the (n_jets, n_kappas) array of the jet charges of all jets 
+    for every kappa in kappas, i.e. the sum over the particles of each jet
+    of charge * (pt / jet_pt)^kappa, with jet_pt the sum of the particle pts.
+
+    jets: a JetCollection, a list of per-jet arrays or an iterable of 
+          JetCollection chunks (e.g. from heppy.iter_event_file).
+    kappas: the values of kappa.
+    chunk_size: the number of jets processed together, which bounds the 
+                temporaries to about chunk_size * particles per jet * n_kappas
+                floats.
+
+    The particles of a chunk are one flat table, so the jet pts and the jet
+    charges are segment reductions over it. log(pt / jet_pt) is computed 
+    once per charged particle and shared by all of the kappas.
+    """
+    kappas = np.asarray(kappas, dtype = float).reshape(-1)
+    results = []
+    for chunk in _jet_chunks(jets, chunk_size):
+        pts, pdgids = chunk.particles[:,pT_i], chunk.particles[:,id_i]
+        jet_ids = chunk.jet_ids
+        jet_pts = np.bincount(jet_ids, weights = pts, minlength = len(chunk))
+
+        # neutral particles don't contribute
+        charges = pdg_charges(pdgids)
+        charged = charges != 0
+        jet_ids = jet_ids[charged]
+        log_pt_fracs = np.log(pts[charged] / jet_pts[jet_ids])
+        # one contiguous row per kappa, which makes the reduction much faster
+        weights = np.multiply.outer(kappas, log_pt_fracs)
+        np.exp(weights, out = weights)
+        weights *= charges[charged]
+
+        # sum the particles of each jet, skipping jets without charged particles
+        counts = np.bincount(jet_ids, minlength = len(chunk))
+        starts = np.cumsum(counts) - counts
+        nonempty = counts > 0
+        chunk_charges = np.zeros((len(chunk), len(kappas)))
+        if np.any(nonempty):
+            chunk_charges[nonempty] = np.add.reduceat(weights, starts[nonempty], 
+                                                      axis = 1).T
+        results.append(chunk_charges)
+
+    if len(results) == 0:
+        return np.zeros((0, len(kappas)))
+    return np.concatenate(results)
+
 def compute_jet_charge(jet, hps, pT_i=2, id_i = 3):
 
     """A functions that inputs an array of jets and returns an array of jet 
@@ -64,13 +129,117 @@ def compute_jet_charge(jet, hps, pT_i=2, id_i = 3):
 
 
     # Compute jet charge
-    jet_charge = 0
-    for pt,label in zip(pts,particle_id):
-        jet_charge += (charge_map[label] * pow(pt, hps["kappa"]))/(pow(jet_pt,hps["kappa"]))
+    jet_charge = np.sum(pdg_charges(particle_id) * pow(pts, hps["kappa"]) 
+                        / pow(jet_pt, hps["kappa"]))
  
     # Return jet charge
     return jet_charge 
 
+_scan_state = {}
+
+def _init_scan_worker(jets, labels, curves, chunk_size):
+    _scan_state.update(jets = jets, labels = labels, curves = curves,
+                       chunk_size = chunk_size)
+
+def _scan_kappas(kappas):
+
+    """Evaluates the jet charge of the scan's jets for a group of kappas and 
+    returns one (auc, rejection, curve) per kappa"""
+    charges = compute_jet_charges(_scan_state['jets'], kappas,
+                                  _scan_state['chunk_size'])
+    curves = _scan_state['curves']
+    rocs = batch_ROC(charges, _scan_state['labels'], efficiencies = [0.5],
+                     num_points = None if curves else 0)
+
+    # the curves as the jet charge scripts save them, (1 - tpr, fpr)
+    return [(rocs['auc'][i], rocs['rejection'][0,i], 
+             (1 - rocs['class1_eff'][i], 1 - rocs['class0_eff'][i]) 
+             if curves else None) for i in range(len(kappas))]
+
+def kappa_scan(jets, labels, kappas, n_workers = 1, curves = False, 
+               filename = '', kappas_per_task = 8, chunk_size = 500):
+
+    """Evaluates jet charge as a classifier for every kappa of a grid, 
+    computing the jet charges of each group of kappas_per_task kappas in one
+    pass with compute_jet_charges.
+
+    jets: a JetCollection (or anything taken by compute_jet_charges).
+    labels: the class of each jet, 0 for particle1 and 1 for particle2.
+    kappas: the grid of kappa values.
+    n_workers: the number of worker processes the kappa groups are split 
+               across. With the fork start method they share jets rather 
+               than receiving copies.
+    curves: if True, the full ROC curve of every kappa is also kept.
+    filename: if given, the results are also pickled to this file.
+
+    Returns a dict with the arrays 'kappa', 'auc' and 'rejection' and, if
+    curves, lists 'particle2_eff' and 'particle1_eff' of the curves 
+    as saved by save_ROC. The rejection is the fraction of particle1 jets
+    rejected, 1 - fpr, at 50% particle2 efficiency (tpr = 0.5), interpolated
+    along the curve, the same as the 'rejection' of batch_ROC.
+    """
+    if not isinstance(jets, JetCollection):
+        jets = concatenate_jets(_jet_chunks(jets, len(labels) or 1))
+    labels = np.asarray(labels)
+    if len(labels) != len(jets):
+        raise ValueError('Number of labels does not match number of jets')
+
+    kappas = np.asarray(kappas, dtype = float).reshape(-1)
+    groups = [kappas[start:start+kappas_per_task] 
+              for start in range(0, len(kappas), kappas_per_task)]
+    state = (jets, labels, curves, chunk_size)
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = max(min(n_workers, len(groups)), 1)
+    if n_workers == 1:
+        _init_scan_worker(*state)
+        try:
+            results = [_scan_kappas(group) for group in groups]
+        finally:
+            _scan_state.clear()
+    else:
+        can_fork = 'fork' in multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if can_fork else None)
+        with context.Pool(n_workers, initializer = _init_scan_worker,
+                          initargs = state) as pool:
+            results = pool.map(_scan_kappas, groups)
+    results = [r for group in results for r in group]
+
+    scan = {'kappa': kappas,
+            'auc': np.array([r[0] for r in results]),
+            'rejection': np.array([r[1] for r in results])}
+    if curves:
+        scan['particle2_eff'] = [r[2][0] for r in results]
+        scan['particle1_eff'] = [r[2][1] for r in results]
+
+    if len(filename) > 0:
+        with open(filename, 'wb') as f:
+            pickle.dump(scan, f)
+    return scan
+
+def jet_charge_scan(hps, kappas, n_workers = None, curves = False, 
+                    filename = ''):
+
+    """Loads the particle1 and particle2 seed files of hps once and runs 
+    kappa_scan over them, labelling particle1 jets 0 and particle2 jets 1.
+    n_workers is used both for loading the files and for the scan"""
+    collections = [load_event_files(_event_file_names(hps, particle_type), 
+                                    n_workers = n_workers)
+                   for particle_type in [hps["particle1_type"], 
+                                         hps["particle2_type"]]]
+    labels = np.concatenate([np.full(len(c), i) 
+                             for i, c in enumerate(collections)])
+    return kappa_scan(concatenate_jets(collections), labels, kappas, 
+                      n_workers = n_workers, curves = curves, 
+                      filename = filename)
+
+def load_kappa_scan(filename):
+
+    """Loads the results of a kappa_scan saved to filename"""
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
 def plot_jet_charges(jet_charges, hps, n_ev_perf = 10000):
 
     '''Plots jet charge histogram'''
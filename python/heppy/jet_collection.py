@@ -0,0 +1,167 @@
+# A compact container for a large number of jets.
+#
+# Rather than a list with one small array per jet, all of the particles are
+# stored in one contiguous table with columns (rap, phi, pt, pdgid) and the
+# particles of jet i are the rows offsets[i]:offsets[i+1]. The overall jet
+# properties (jet_rap, jet_phi, jet_pt) are kept in a separate per-jet table.
+# Indexing a single jet returns a view into the particle table, so the
+# collection can be used anywhere a list of jets was used before.
+
+import numpy as np
+
+__all__ = ['JetCollection', 'concatenate_jets', 'jets_from_list']
+
+NB_JET_TOT_COLS = 3
+
+
+class JetCollection(object):
+
+    """ A jagged array of jets.
+
+    particles: an (nb_particles, 4) array with rows (rap, phi, pt, pdgid).
+    offsets: an array of length nb_jets + 1 with offsets[0] = 0, such that
+             the particles of jet i are particles[offsets[i]:offsets[i+1]].
+    jet_tots: an (nb_jets, 3) array with rows (jet_rap, jet_phi, jet_pt). If
+              not given it is filled with zeros.
+    """
+
+    def __init__(self, particles, offsets, jet_tots = None):
+
+        self.particles = particles
+        self.offsets = np.asarray(offsets, dtype = np.int64)
+        if jet_tots is None:
+            jet_tots = np.zeros((len(self.offsets) - 1, NB_JET_TOT_COLS))
+        self.jet_tots = jet_tots
+
+        if len(self.offsets) == 0 or self.offsets[0] != 0 or \
+           self.offsets[-1] != len(particles):
+            raise ValueError('Offsets do not match the particle table')
+        if len(self.jet_tots) != len(self):
+            raise ValueError('Number of jet_tots does not match number of jets')
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.particles[self.offsets[i]:self.offsets[i+1]]
+
+    def __getitem__(self, key):
+
+        """ An integer returns the particles of that jet as a view, a slice
+        returns a JetCollection sharing the particle table, and an array of
+        indices or a boolean mask returns a JetCollection holding a copy of
+        the selected jets. """
+
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError('Jet index out of range')
+            return self.particles[self.offsets[key]:self.offsets[key+1]]
+
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step == 1:
+                stop = max(start, stop)
+                offsets = self.offsets[start:stop+1]
+                return JetCollection(self.particles[offsets[0]:offsets[-1]],
+                                     offsets - offsets[0],
+                                     self.jet_tots[start:stop])
+            key = np.arange(start, stop, step)
+
+        # general selection of jets, gather their particles
+        indices = np.arange(len(self))[key]
+        counts = self.counts[indices]
+        offsets = np.zeros(len(indices) + 1, dtype = np.int64)
+        np.cumsum(counts, out = offsets[1:])
+        rows = np.repeat(self.offsets[indices] - offsets[:-1], counts) + \
+               np.arange(offsets[-1])
+        return JetCollection(self.particles[rows], offsets,
+                             self.jet_tots[indices])
+
+    def __repr__(self):
+        return 'JetCollection({} jets, {} particles)'.format(len(self),
+                                                            self.nb_particles)
+
+    @property
+    def nb_particles(self):
+        return len(self.particles)
+
+    @property
+    def counts(self):
+
+        """ The number of particles in each jet. """
+
+        return np.diff(self.offsets)
+
+    @property
+    def jet_ids(self):
+
+        """ The index of the jet that each particle belongs to. """
+
+        return np.repeat(np.arange(len(self)), self.counts)
+
+    @property
+    def raps(self):
+        return self.particles[:,0]
+
+    @property
+    def phis(self):
+        return self.particles[:,1]
+
+    @property
+    def pts(self):
+        return self.particles[:,2]
+
+    @property
+    def pdgids(self):
+        return self.particles[:,3]
+
+    def to_list(self):
+
+        """ Returns the jets as a list of per-jet arrays (views). """
+
+        return list(self)
+
+
+def concatenate_jets(collections):
+
+    """ Concatenates a sequence of JetCollections into a single one, copying
+    each particle table once into a preallocated result. """
+
+    collections = list(collections)
+    if len(collections) == 0:
+        return JetCollection(np.zeros((0, 4)), np.zeros(1, dtype = np.int64))
+
+    nb_particles = sum(c.nb_particles for c in collections)
+    nb_jets = sum(len(c) for c in collections)
+    particles = np.empty((nb_particles, collections[0].particles.shape[1]),
+                         dtype = collections[0].particles.dtype)
+    offsets = np.zeros(nb_jets + 1, dtype = np.int64)
+    jet_tots = np.empty((nb_jets, collections[0].jet_tots.shape[1]),
+                        dtype = collections[0].jet_tots.dtype)
+
+    p_index, j_index = 0, 0
+    for c in collections:
+        particles[p_index:p_index+c.nb_particles] = c.particles
+        offsets[j_index+1:j_index+len(c)+1] = c.offsets[1:] + p_index
+        jet_tots[j_index:j_index+len(c)] = c.jet_tots
+        p_index += c.nb_particles
+        j_index += len(c)
+
+    return JetCollection(particles, offsets, jet_tots)
+
+
+def jets_from_list(jets, jet_tots = None):
+
+    """ Builds a JetCollection from a list of per-jet particle arrays. """
+
+    counts = [len(jet) for jet in jets]
+    offsets = np.zeros(len(jets) + 1, dtype = np.int64)
+    np.cumsum(counts, out = offsets[1:])
+    particles = np.concatenate([np.reshape(jet, (-1, 4)) for jet in jets]) \
+                if len(jets) > 0 else np.zeros((0, 4))
+    if jet_tots is not None:
+        jet_tots = np.asarray(jet_tots, dtype = float).reshape((-1, NB_JET_TOT_COLS))
+    return JetCollection(particles, offsets, jet_tots)
@@ -0,0 +1,113 @@
+# Locality-aware shuffling of datasets stored on disk.
+#
+# A full np.random.permutation turns every minibatch of a memory-mapped or
+# chunked image file into reads scattered over the whole file. Instead, the
+# samples are grouped into contiguous blocks, the order of the blocks is
+# shuffled, and then consecutive groups of blocks are read into a bounded
+# shuffle buffer and shuffled within it. Every read is then a contiguous run
+# of block_size samples. block_size and buffer_blocks set how random the
+# order is: block_size = 1 is a full shuffle, and the larger the buffer the
+# better mixed each minibatch is.
+#
+# The datasets list all samples of one class before those of the next
+# (e.g. gluons then quarks, as make_labels assumes), so blocks never straddle
+# a class boundary and the blocks of the classes are interleaved in
+# proportion to their sizes, which keeps every buffer class-balanced.
+
+import numpy as np
+
+__all__ = ['BlockShuffleSampler']
+
+
+class BlockShuffleSampler(object):
+
+    """ Generates block-shuffled orders of the samples of a dataset.
+
+    nb_samples: the number of samples in the dataset.
+    block_size: the number of consecutive samples read together. Aligning it
+                with the block size of a ChunkedImageFile means every block
+                is decompressed once per epoch.
+    buffer_blocks: the number of blocks shuffled together in memory.
+    boundaries: the indices at which a new class begins, e.g. [nb_gluons].
+    seed: if given, the order of epoch e comes from RandomState(seed + e)
+          and is reproducible.
+    """
+
+    def __init__(self, nb_samples, block_size = 1024, buffer_blocks = 16,
+                 boundaries = [], seed = None):
+
+        assert block_size > 0 and buffer_blocks > 0, 'Invalid block sizes'
+        self.nb_samples = nb_samples
+        self.block_size, self.buffer_blocks = block_size, buffer_blocks
+        self.seed = seed
+
+        # the blocks of every class, as (start, stop) pairs
+        edges = [0] + sorted(b for b in boundaries if 0 < b < nb_samples) + [nb_samples]
+        self.class_blocks = [np.array([(start, min(start + block_size, stop))
+                                       for start in range(lo, stop, block_size)],
+                                      dtype = np.int64).reshape(-1, 2)
+                             for lo, stop in zip(edges[:-1], edges[1:])]
+
+    def __len__(self):
+        return self.nb_samples
+
+    def _rng(self, epoch):
+        return np.random.RandomState(None if self.seed is None else self.seed + epoch)
+
+    def block_order(self, epoch = 0, rng = None):
+
+        """ Returns the (start, stop) of the blocks in the order of epoch.
+        Each class's blocks are shuffled, and the classes are interleaved by
+        giving block k of a class with n blocks a position (k + u) / n, with
+        u uniform in [0, 1), so every stretch of blocks holds the classes in
+        proportion to their sizes. """
+
+        rng = self._rng(epoch) if rng is None else rng
+        blocks, positions = [], []
+        for class_blocks in self.class_blocks:
+            n = len(class_blocks)
+            blocks.append(class_blocks[rng.permutation(n)])
+            positions.append((np.arange(n) + rng.uniform(size = n)) / max(n, 1))
+        blocks = np.concatenate(blocks)
+        return blocks[np.argsort(np.concatenate(positions), kind = 'stable')]
+
+    def buffers(self, epoch = 0):
+
+        """ Yields, for each shuffle buffer of epoch, the (start, stop) of its
+        blocks in increasing order and the permutation of the buffer's
+        samples, i.e. the buffer is read with one contiguous read per block
+        and its samples are then taken in the order of the permutation. """
+
+        rng = self._rng(epoch)
+        blocks = self.block_order(epoch, rng)
+        for start in range(0, len(blocks), self.buffer_blocks):
+            buffer = blocks[start:start+self.buffer_blocks]
+            buffer = buffer[np.argsort(buffer[:,0])]
+            yield buffer, rng.permutation(int(np.sum(buffer[:,1] - buffer[:,0])))
+
+    def epoch_order(self, epoch = 0):
+
+        """ Returns the order of all samples in epoch as one index array,
+        e.g. in place of np.random.permutation(nb_samples). """
+
+        orders = []
+        for blocks, perm in self.buffers(epoch):
+            rows = np.concatenate([np.arange(lo, hi) for lo, hi in blocks])
+            orders.append(rows[perm])
+        return np.concatenate(orders) if len(orders) > 0 else np.zeros(0, dtype = np.int64)
+
+    def iter_batches(self, X, Y = None, batch_size = 128, epoch = 0):
+
+        """ Yields the minibatches of one epoch of X (and Y). Each shuffle
+        buffer is read with one contiguous slice per block, so a memory map
+        or ChunkedImageFile is read sequentially, and its minibatches are
+        then gathered in memory. The last minibatch of a buffer may be
+        smaller than batch_size. """
+
+        for blocks, perm in self.buffers(epoch):
+            X_buffer = np.concatenate([X[lo:hi] for lo, hi in blocks])
+            if Y is not None:
+                Y_buffer = np.concatenate([Y[lo:hi] for lo, hi in blocks])
+            for start in range(0, len(perm), batch_size):
+                rows = perm[start:start+batch_size]
+                yield X_buffer[rows] if Y is None else (X_buffer[rows], Y_buffer[rows])
@@ -6,6 +6,7 @@
 import sys
 import os
 import numpy as np
+from contextlib import contextmanager
 
 
 def parg(arg):
@@ -57,6 +58,38 @@ def get_unique_file_name(path, filename, suffix = ''):
     raise NameError("Could not find unique filename for {} in {}".format(filename, path))
 
 
+def temporary_name(filename):
+
+    """ The name under which filename is written by this process before it is
+    moved into place. """
+
+    return '{}.tmp{}'.format(filename, os.getpid())
+
+
+@contextmanager
+def atomic_write(filename, mode = 'wb'):
+
+    """ Opens a temporary file next to filename for writing and, once the with
+    block completes, moves it over filename, so other readers only ever see
+    the old file or the complete new one. If the block raises, the temporary
+    file is removed and filename is left untouched.
+
+    Usage: with atomic_write(filename) as fh: np.save(fh, array)
+    """
+
+    tmp_name = temporary_name(filename)
+    try:
+        with open(tmp_name, mode) as fh:
+            yield fh
+        os.replace(tmp_name, filename)
+    except BaseException:
+        try:
+            os.remove(tmp_name)
+        except OSError:
+            pass
+        raise
+
+
 def save_model(model, name, path = '../models'):
 
     """ A function for saving a Keras model. Safely ensures that directories 
@@ -71,7 +104,127 @@ def save_model(model, name, path = '../models'):
     model.save(os.path.join(path, name))
 
 
-def data_split(*args, val_frac = .1, test_frac = .1):
+class IndexedArray(object):
+
+    """ A lazy view of the rows indices of base, e.g. of a memory-mapped
+    dataset, which behaves like the array base[indices] without copying it.
+    Rows are only gathered (and passed through transform) when the view is
+    indexed, so training can go through the view batch by batch.
+
+    base: the array the rows are taken from.
+    indices: the indices of the rows of base in the view.
+    transform: if given, a function applied to every batch of rows gathered 
+               from base, e.g. a normalization. It must not change the shape.
+    """
+
+    def __init__(self, base, indices, transform = None):
+
+        self.base = base
+        self.indices = np.asarray(indices, dtype = np.int64)
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __repr__(self):
+        return 'IndexedArray({} rows of {})'.format(len(self), type(self.base).__name__)
+
+    @property
+    def shape(self):
+        return (len(self),) + tuple(self.base.shape[1:])
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return self.base.dtype
+
+    def __getitem__(self, key):
+
+        """ Gathers the selected rows. An integer gives a single row, a tuple
+        selects rows with its first entry and indexes within them with the 
+        rest. """
+
+        rest = ()
+        if isinstance(key, tuple):
+            key, rest = key[0], key[1:]
+        rows = self.indices[key]
+        single = np.ndim(rows) == 0
+        rows = np.atleast_1d(rows)
+
+        # gather in increasing order, which is kinder to memory maps
+        order = np.argsort(rows, kind = 'stable')
+        batch = np.empty((len(rows),) + tuple(self.base.shape[1:]), dtype = self.dtype)
+        batch[order] = self.base[rows[order]]
+        if self.transform is not None:
+            batch = self.transform(batch)
+
+        if single:
+            return batch[0][rest]
+        return batch[(slice(None),) + rest]
+
+    def __array__(self, dtype = None, copy = None):
+        batch = self[:]
+        return batch if dtype is None else batch.astype(dtype, copy = False)
+
+    def with_transform(self, transform):
+
+        """ Returns a view of the same rows with another transform. """
+
+        return IndexedArray(self.base, self.indices, transform)
+
+
+def split_indices(n_samples, val_frac = .1, test_frac = .1, seed = None,
+                  split_file = ''):
+
+    """ Returns the (train, val, test) index arrays of a random split of 
+    n_samples samples, as used by data_split.
+
+    seed: if given, the split is drawn from np.random.RandomState(seed) and
+          is always the same, otherwise it comes from the global generator.
+    split_file: if given (and seed is not None), the split is saved to this
+                .npz file and reloaded from it whenever n_samples, the
+                fractions and the seed are the same.
+    """
+
+    assert 0 <= val_frac <= 1.0, 'val_frac invalid'
+    assert 0 <= test_frac <= 1.0, 'test_frac invalid'
+
+    key = np.array([n_samples, val_frac, test_frac, -1 if seed is None else seed],
+                   dtype = np.float64)
+    use_file = len(split_file) > 0 and seed is not None
+    if use_file:
+        try:
+            with np.load(split_file) as data:
+                if np.array_equal(data['key'], key):
+                    return data['train'], data['val'], data['test']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    rng = np.random if seed is None else np.random.RandomState(seed)
+    perm = rng.permutation(n_samples)
+
+    num_test = int(n_samples * test_frac)
+    num_val = int(n_samples * val_frac)
+    num_train = n_samples - num_val - num_test
+    train, test = perm[:num_train], perm[num_train:num_train+num_test]
+    val = perm[n_samples-num_val:]
+
+    if use_file:
+        try:
+            with atomic_write(split_file) as fh:
+                np.savez(fh, key = key, train = train, val = val, test = test)
+        except OSError:
+            # e.g. a read-only directory, the split is still usable
+            pass
+
+    return train, val, test
+
+
+def data_split(*args, val_frac = .1, test_frac = .1, seed = None, 
+               split_file = '', lazy = False):
 
     """ A function to split an arbitrary number of arrays into train, 
     validation, and test sets. If val_frac = 0, then we don't split any 
@@ -85,12 +238,13 @@ def data_split(*args, val_frac = .1, test_frac = .1):
     val_frac: fraction of all samples to put in the val dataset. zero means we 
               don't return a val dataset at all
     test_frac: fraction of all samples to put in the test dataset.
+    seed: if given, the split is reproducible, see split_indices.
+    split_file: if given with a seed, the split indices are cached in this 
+                file, see split_indices.
+    lazy: if True, the splits are IndexedArray views of the arguments rather
+          than copies.
     """
 
-    # ensure proper input
-    assert 0 <= val_frac <= 1.0, 'val_frac invalid'
-    assert 0 <= test_frac <= 1.0, 'test_frac invalid'
-
     # confirm that all arguments have the same number of samples
     if len(args) == 0:
         raise RuntimeError('Need to pass at least one argument to data_split')
@@ -99,29 +253,29 @@ def data_split(*args, val_frac = .1, test_frac = .1):
         if len(arg) != n_samples:
             raise AssertionError('Args to data_split have different length')
 
-    perm = np.random.permutation(n_samples)
-
-    num_test = int(n_samples * test_frac)
-    num_val = int(n_samples * val_frac)
-    num_train = n_samples - num_val - num_test
+    train, val, test = split_indices(n_samples, val_frac, test_frac, seed, 
+                                     split_file)
+    take = (lambda arg, indices: IndexedArray(arg, indices)) if lazy else \
+           (lambda arg, indices: arg[indices])
+    num_val = len(val)
 
     # if we're doing the conventional train-val-test-split
     if len(args) == 2:
-        X_train = args[0][perm[:num_train]]
-        Y_train = args[1][perm[:num_train]]
-        X_test  = args[0][perm[num_train:num_train+num_test]]
-        Y_test  = args[1][perm[num_train:num_train+num_test]]
+        X_train = take(args[0], train)
+        Y_train = take(args[1], train)
+        X_test  = take(args[0], test)
+        Y_test  = take(args[1], test)
         if num_val > 0:
-            X_val = args[0][perm[-num_val:]]
-            Y_val = args[1][perm[-num_val:]]
+            X_val = take(args[0], val)
+            Y_val = take(args[1], val)
             return X_train, Y_train, X_val, Y_val, X_test, Y_test
         else:
             return X_train, Y_train, X_test, Y_test
     else:
-        train = [arg[perm[:num_train]] for arg in args]
-        test = [arg[perm[num_train:num_train+num_test]] for arg in args]
+        train_split = [take(arg, train) for arg in args]
+        test_split = [take(arg, test) for arg in args]
         if num_val > 0:
-            val = [arg[perm[-num_val:]] for arg in args]
-            return train, val, test
+            val_split = [take(arg, val) for arg in args]
+            return train_split, val_split, test_split
         else:
-            return train, test
+            return train_split, test_split
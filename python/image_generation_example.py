@@ -14,7 +14,7 @@ n_files = 2
 jets, jet_tots = data_import('event', range(1,1 + n_files))
 
 # form the jet images
-jet_images = np.asarray([heppy.pixelate(jet, nb_chan = 3) for jet in jets])
+jet_images = heppy.pixelate_parallel(jets, nb_chan = 3)
 
 # save the jet images to file
 heppy.write_images_to_file('example_jet_images', jet_images)
\ No newline at end of file
@@ -21,8 +21,8 @@ for energy in ['1000GEV']:
             # import the jets
             jets, jet_tots = data_import('event', range(1,1 + n_files), seed_number, particle_type, energy)
 
-            # form the jet images
-            jet_images = np.asarray([heppy.pixelate(jet, nb_chan = 2,img_width = 0.8) for jet in jets])
+            # form the jet images, in parallel straight into shared memory
+            jet_images = heppy.pixelate_parallel(jets, nb_chan = 2, img_width = 0.8)
  
             # save the jet images to file
             filename = energy + '-' + particle_type + '-K=nocharge-jetimage-seed' + str(seed_number)
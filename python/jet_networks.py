@@ -5,13 +5,17 @@
 
 import numpy as np
 import math
+import os
 import heppy
 from heppy import NN_models
 from heppy import jet_RGB_images
 from data_import_modified import data_import
 from keras.callbacks import EarlyStopping
+from keras_helpers import Prefetcher, BatchPipeline, DataWaitLogger
 
-n_parts = 1
+# seed of the train/val/test split, fixed so that the split and the
+# normalization statistics can be cached next to the dataset and reused
+split_seed = 0
 
 def train_CNN(hps):
     # import existing jet images
@@ -20,43 +24,61 @@ def train_CNN(hps):
     # get labels for the images
     Y = heppy.make_labels(hps['n_files']*10000, hps['n_files']*10000)
 
-    # split the data into train, validation, and test sets
-    X_train, Y_train, X_val, Y_val, X_test, Y_test = heppy.data_split(jet_images,Y)
+    # split the data into train, validation, and test sets. The splits are
+    # lazy views of the memory-mapped images, and both the split and the
+    # normalization statistics are cached next to the image store
+    cache_base = os.path.splitext(jet_images.filename)[0] + '.seed{}'.format(split_seed) \
+                 if isinstance(jet_images, np.memmap) else ''
+    X_train, Y_train, X_val, Y_val, X_test, Y_test = heppy.data_split(jet_images, Y, 
+        seed = split_seed, split_file = cache_base + '.split.npz' if cache_base else '', 
+        lazy = True)
 
-    # preprocess the data
-    X_train, X_val, X_test = heppy.zero_center(X_train, X_val, X_test, channels = [0])
-    X_train, X_val, X_test = heppy.standardize(X_train, X_val, X_test, channels = [0])
+    # preprocess the data, the images are normalized as batches are gathered
+    X_train, X_val, X_test = heppy.lazy_normalize(X_train, X_val, X_test, channels = [0],
+        stats_file = cache_base + '.stats.npz' if cache_base else '', 
+        key = {'shape': list(jet_images.shape)})
+    Y_train, Y_val, Y_test = np.asarray(Y_train), np.asarray(Y_val), np.asarray(Y_test)
+
+    # Keras only takes arrays, so the (smaller) validation and test sets are
+    # gathered once, while the training set is streamed batch by batch
+    X_val, X_test = np.asarray(X_val), np.asarray(X_test)
     
     model = NN_models.conv_net_construct(hps)
 
     if hps['data_augment'] is True:
-        # Divide data into smaller chunks for data augmentation
-        X_split = np.split(X_train, hps['n_files']*n_parts)
-        Y_split = np.split(Y_train, hps['n_files']*n_parts)
-
-        # Data Augmentation and Train for Each Subset
-        for i in range(hps['n_files']*n_parts):
-            print('File_number: ' + str((i+1)/n_parts))
-            X_aug, Y_aug = heppy.apply_jitter(X_split[0], Y_split[0])
-            del X_split[0]
-            del Y_split[0]
-            history = model.fit(X_aug, Y_aug,
-                                batch_size = hps['batch_size'],
-                                epochs     = hps['epochs'],
-                                callbacks  = [EarlyStopping(monitor = 'val_loss', 
-                                                            patience = hps['patience'], 
-                                                            verbose = 1, 
-                                                            mode = 'auto')],
-                                validation_data = (X_val, Y_val))
+        # Jitter the images lazily per minibatch, each epoch goes through
+        # every reflection and translation of every training image once.
+        # The batches are built ahead of time by a pool of threads
+        augmenter = heppy.JitterAugmenter(X_train, Y_train, 
+                                          batch_size = hps['batch_size'])
+        batches = Prefetcher(lambda task: augmenter.batch(*task), augmenter.tasks(),
+                             n_workers = hps.get('n_workers', 2),
+                             queue_size = hps.get('queue_size', 8))
+        history = model.fit_generator(iter(batches),
+                                      steps_per_epoch = len(augmenter),
+                                      epochs     = hps['epochs'],
+                                      callbacks  = [EarlyStopping(monitor = 'val_loss', 
+                                                                  patience = hps['patience'], 
+                                                                  verbose = 1, 
+                                                                  mode = 'auto'),
+                                                    DataWaitLogger(batches)],
+                                      validation_data = (X_val, Y_val))
     if hps['data_augment'] is False:
-        history = model.fit(X_train, Y_train,
-                            batch_size = hps['batch_size'],
-                            epochs     = hps['epochs'],
-                            callbacks  = [EarlyStopping(monitor = 'val_loss',
-                                                        patience = hps['patience'],
-                                                        verbose = 1,
-                                                        mode = 'auto')],
-                            validation_data = (X_val, Y_val)) 
+        # shuffled minibatches of the lazy training set, gathered and
+        # normalized ahead of time by a pool of threads
+        batches = BatchPipeline(X_train, Y_train, batch_size = hps['batch_size'],
+                                shuffle = True, seed = split_seed,
+                                n_workers = hps.get('n_workers', 2),
+                                queue_size = hps.get('queue_size', 8))
+        history = model.fit_generator(iter(batches),
+                                      steps_per_epoch = len(batches),
+                                      epochs     = hps['epochs'],
+                                      callbacks  = [EarlyStopping(monitor = 'val_loss',
+                                                                  patience = hps['patience'],
+                                                                  verbose = 1,
+                                                                  mode = 'auto'),
+                                                    DataWaitLogger(batches)],
+                                      validation_data = (X_val, Y_val))
 
     # get a unique name to save the model as
     name = heppy.get_unique_file_name('../models', hps['model_name'],
@@ -1,25 +1,206 @@
 #Katherine Fraser, Harvard, 2017
 #
 # Generator for Real Time Theano data augmentation
+#
+# Batches are prepared ahead of time by a pool of threads: indexing (numpy
+# copies and memory-map reads), augmentation and normalization all release
+# the GIL for most of their work. A bounded queue of ready batches is kept
+# and the batches are handed out in a fixed order, so the batch sequence is
+# deterministic however the workers are scheduled. The time the training
+# loop spends waiting on the queue is recorded for every step.
 
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from time import perf_counter
 from heppy import apply_jitter
-from keras.preprocessing.image import ImageDataGenerator
+from keras.callbacks import Callback
 
-def generator(hps, X_train, Y_train):
-    if hps['nb_channels'] in {1,3}:
-        datagen = ImageDataGenerator()
-        for X_batch, Y_batch in datagen.flow(X_train, Y_train, batch_size=hps['batch_size']):
-            X_aug, Y_aug = apply_jitter(X_batch,Y_batch)
-            yield X_aug, Y_aug
-    if hps['nb_channels'] == 2:
-        counter = 0
+__all__ = ['generator', 'Prefetcher', 'BatchPipeline', 'DataWaitLogger']
+
+
+class Prefetcher(object):
+
+    """ Runs make_batch(task) for each task of tasks in a thread pool, keeping
+    up to queue_size batches in flight, and yields the batches in the order of
+    tasks. The time spent waiting for each batch is appended to wait_times,
+    which keeps the last max_wait_times of them, and steps counts all the
+    batches yielded so far.
+
+    make_batch: a function building a batch from a task.
+    tasks: an iterable (possibly endless) of tasks, computed in the consuming
+           thread so that their order never depends on the workers.
+    n_workers: the number of threads building batches.
+    queue_size: the number of batches prepared ahead of the training loop.
+    """
+
+    def __init__(self, make_batch, tasks, n_workers = 2, queue_size = 8,
+                 max_wait_times = 100000):
+
+        assert n_workers > 0 and queue_size > 0, 'Invalid prefetching sizes'
+        self.make_batch = make_batch
+        self.tasks = tasks
+        self.n_workers, self.queue_size = n_workers, queue_size
+        self.wait_times = deque(maxlen = max_wait_times)
+        self.steps = 0
+
+    def __iter__(self):
+        tasks = iter(self.tasks)
+        with ThreadPoolExecutor(self.n_workers) as pool:
+            pending = deque(pool.submit(self.make_batch, task)
+                            for task in islice(tasks, self.queue_size))
+            while len(pending) > 0:
+                start = perf_counter()
+                batch = pending.popleft().result()
+                self.wait_times.append(perf_counter() - start)
+                self.steps += 1
+                for task in islice(tasks, 1):
+                    pending.append(pool.submit(self.make_batch, task))
+                yield batch
+
+    def wait_summary(self, last = None):
+
+        """ Returns the mean, max and total data-wait time in seconds over the
+        last steps (all steps if None), and the fraction of steps that waited
+        more than a millisecond. Only the last max_wait_times steps are 
+        recorded, so the times are those of at most that many steps, while
+        'steps' is the number of steps asked for. """
+
+        steps = self.steps if last is None else min(max(last, 0), self.steps)
+        waits = np.asarray(self.wait_times)
+        waits = waits[max(len(waits) - steps, 0):] if steps > 0 else waits[:0]
+        if len(waits) == 0:
+            return {'steps': steps, 'mean': 0., 'max': 0., 'total': 0., 'starved': 0.}
+        return {'steps': steps, 'mean': float(np.mean(waits)),
+                'max': float(np.max(waits)), 'total': float(np.sum(waits)),
+                'starved': float(np.mean(waits > 1e-3))}
+
+
+class BatchPipeline(Prefetcher):
+
+    """ An endless stream of (X_batch, Y_batch) minibatches of X and Y built
+    by a Prefetcher, e.g. for Keras' fit_generator.
+
+    Batches are consecutive runs of batch_size samples which wrap around the
+    end of the data into the next epoch. Without shuffling, a batch is taken
+    with one or two slices rather than sample by sample. With shuffling, the
+    samples of epoch e are permuted with np.random.RandomState(seed + e), so
+    the sequence of batches is reproducible, and each batch is gathered in
+    increasing row order.
+
+    X, Y: the data, anything indexable by slices and arrays of rows, e.g.
+          arrays, memory maps or the lazy views of heppy.data_split. Y may be
+          None, in which case only X batches are produced.
+    transform: if given, a function (X_batch, Y_batch) -> (X_batch, Y_batch)
+               run by the workers on every batch, e.g. augmentation and
+               normalization.
+    sampler: if given, e.g. a heppy.BlockShuffleSampler, the order of epoch e
+             is sampler.epoch_order(e) instead of a full permutation, so that
+             every batch reads from a few contiguous blocks of X.
+    """
+
+    def __init__(self, X, Y = None, batch_size = 128, shuffle = True, seed = 0,
+                 transform = None, n_workers = 2, queue_size = 8, sampler = None):
+
+        if Y is not None and len(Y) != len(X):
+            raise ValueError('X and Y have different lengths')
+        self.X, self.Y = X, Y
+        self.batch_size = batch_size
+        self.shuffle, self.seed = shuffle, seed
+        self.transform = transform
+        self.sampler = sampler
+        if sampler is not None and len(sampler) != len(X):
+            raise ValueError('The sampler and X have different lengths')
+        super(BatchPipeline, self).__init__(self._build_batch, self._batch_rows(),
+                                            n_workers, queue_size)
+
+    def __len__(self):
+
+        """ The number of batches per epoch, e.g. for steps_per_epoch. """
+
+        return -(-len(self.X) // self.batch_size)
+
+    def _epoch_order(self, epoch):
+        if self.sampler is not None:
+            return self.sampler.epoch_order(epoch)
+        if not self.shuffle:
+            return None
+        seed = None if self.seed is None else self.seed + epoch
+        return np.random.RandomState(seed).permutation(len(self.X))
+
+    def _batch_rows(self):
+
+        """ Yields the rows of every batch, as a list of slices or sorted
+        index arrays, one per epoch the batch touches. """
+
+        n, position, epoch = len(self.X), 0, 0
+        order = self._epoch_order(epoch)
         while True:
-            X_batch = np.stack([X_train[i % len(X_train) ,:,:,:] for i in range(counter, counter + hps['batch_size'])])
-            Y_batch = np.stack([Y_train[i % len(X_train),:] for i in range(counter, counter + hps['batch_size'])])
-            counter += hps['batch_size']
-            counter = counter % len(X_train)
-            X_aug, Y_aug = apply_jitter(X_batch,Y_batch)
-            yield X_aug, Y_aug
+            pieces, needed = [], self.batch_size
+            while needed > 0:
+                stop = min(position + needed, n)
+                pieces.append(slice(position, stop) if order is None else
+                              np.sort(order[position:stop]))
+                needed -= stop - position
+                position = stop
+                if position == n:
+                    position, epoch = 0, epoch + 1
+                    order = self._epoch_order(epoch)
+            yield pieces
+
+    def _build_batch(self, pieces):
+        X_batch = np.concatenate([self.X[rows] for rows in pieces]) \
+                  if len(pieces) > 1 else np.asarray(self.X[pieces[0]])
+        Y_batch = None
+        if self.Y is not None:
+            Y_batch = np.concatenate([self.Y[rows] for rows in pieces]) \
+                      if len(pieces) > 1 else np.asarray(self.Y[pieces[0]])
+        if self.transform is not None:
+            X_batch, Y_batch = self.transform(X_batch, Y_batch)
+        return X_batch if self.Y is None else (X_batch, Y_batch)
+
+
+class DataWaitLogger(Callback):
+
+    """ A Keras callback reporting how long the training loop waited for
+    batches from a Prefetcher during each epoch, also stored in the logs as
+    'data_wait' (mean seconds per step) and 'data_starved' (fraction of steps
+    that waited more than a millisecond). """
+
+    def __init__(self, prefetcher, verbose = 1):
+        super(DataWaitLogger, self).__init__()
+        self.prefetcher = prefetcher
+        self.verbose = verbose
+
+    def on_epoch_begin(self, epoch, logs = None):
+        self._steps_before = self.prefetcher.steps
+
+    def on_epoch_end(self, epoch, logs = None):
+        summary = self.prefetcher.wait_summary(self.prefetcher.steps
+                                               - self._steps_before)
+        if logs is not None:
+            logs['data_wait'] = summary['mean']
+            logs['data_starved'] = summary['starved']
+        if self.verbose:
+            print('Data wait: {:.2f} ms/step on average, {:.2f} ms max, {:.0%} of '
+                  'steps starved'.format(1000 * summary['mean'], 1000 * summary['max'],
+                                         summary['starved']))
+
+
+def _jitter(X_batch, Y_batch):
+    return apply_jitter(X_batch, Y_batch)
+
+
+def generator(hps, X_train, Y_train):
 
+    """ Yields jittered batches of X_train, Y_train forever. Each batch of
+    hps['batch_size'] samples is expanded with apply_jitter. 1 and 3 channel
+    images are shuffled every epoch, 2 channel images are taken in order.
+    hps may set 'n_workers' and 'queue_size' for the prefetching. """
 
+    return iter(BatchPipeline(X_train, Y_train, hps['batch_size'],
+                              shuffle = hps['nb_channels'] in {1,3},
+                              seed = hps.get('seed', 0), transform = _jitter,
+                              n_workers = hps.get('n_workers', 2),
+                              queue_size = hps.get('queue_size', 8)))